@@ -0,0 +1,232 @@
+''' Group analysis over the processed results of all participants.
+
+Every run of the Excel table also saves its results as a tidy long table (one row per participant,
+event, modality and feature) in data/processed. The group stage indexes these files, loads the new
+or changed ones in bulk and appends them to one group table, so adding a participant does not reread
+everyone. Older runs that only have the Excel file are read from it. Per-condition statistics and
+group bar plots are computed from the group table:
+
+    cd src && python -m analysis.group_analysis
+'''
+import argparse
+import re
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import matplotlib.pyplot as plt
+
+KEY_COLUMNS = ["participant_id", "researcher_initials", "date"]
+# Same rows as the per-participant bar graphs
+IMPORTANT_FEATURES = {
+    "rsp": ["RSP_Rate_Mean", "RRV_RMSSD"],
+    "eda": ["SCR_Peaks_N", "EDA_Sympathetic"],
+    "ecg": ["ECG_Rate_Mean", "HRV_MeanNN"],
+}
+RESULT_TYPES = ["long", "excel_table"]
+# processed_data_<type>_<participant id>_<initials>_<YYYY_MM_DD>.<suffix>, anchored on the trailing date so
+# participant IDs with underscores (e.g. sub_01) are kept whole, the initials are the part before the date
+FILE_NAME = re.compile(r"processed_data_(?P<type>long|excel_table)_(?P<participant_id>.+)_(?P<researcher_initials>[^_]+)_(?P<date>\d{4}_\d{2}_\d{2})$")
+
+def processed_folder() -> Path:
+    script_dir = Path(__file__).resolve().parent.parent
+    return script_dir.parent / "data" / "processed"
+
+def _to_float(value):
+    # ecg_analyze returns some features as 1x1 arrays, which the Excel files store as "[[856.9]]"
+    if isinstance(value, str):
+        value = value.strip("[] ")
+    try:
+        values = np.asarray(value, dtype=float).ravel()
+    except (TypeError, ValueError):
+        return np.nan
+    return values[0] if values.size == 1 else np.nan
+
+def condition_of(labels: pd.Series) -> pd.Series:
+    # "2ndSilence_7" -> "Silence": the numbering of repeated conditions is dropped
+    return labels.str.replace(r"_\d+$", "", regex=True).str.replace(r"^\d+(st|nd|rd|th)", "", regex=True).str.strip()
+
+def long_table(tables: dict, participant_id: str, researcher_initials: str, date: str, protocol: str = None) -> pd.DataFrame:
+    '''
+    One tidy table from the per-modality result tables (features as rows, events as columns).
+    '''
+    frames = []
+    for modality, table in tables.items():
+        if table is None or table.empty:
+            continue
+        long = table.rename_axis(index="feature", columns=None).reset_index().melt(id_vars="feature", var_name="event", value_name="value")
+        long.insert(0, "modality", modality)
+        frames.append(long)
+    if not frames:
+        return pd.DataFrame(columns=KEY_COLUMNS + ["protocol", "modality", "feature", "event", "condition", "value"])
+
+    long = pd.concat(frames, ignore_index=True)
+    if long["value"].dtype == object:
+        long["value"] = long["value"].map(_to_float)
+    long["value"] = long["value"].astype(float)
+    long["event"] = long["event"].astype(str)
+    long["condition"] = condition_of(long["event"])
+    long.insert(0, "participant_id", participant_id)
+    long.insert(1, "researcher_initials", researcher_initials)
+    long.insert(2, "date", date)
+    long.insert(3, "protocol", protocol)
+    return long
+
+def _long_table_key(path: Path) -> dict:
+    # The key columns of a long table (the same on every row), None for an empty table
+    keys = pq.read_table(path, columns=KEY_COLUMNS).slice(0, 1).to_pylist()
+    return {column: str(value) for column, value in keys[0].items()} if keys else None
+
+def _read_excel_results(path: Path, key: dict) -> pd.DataFrame:
+    # Runs from before the long tables were saved, the sheets are <MODALITY>_Analysis
+    sheets = pd.read_excel(path, sheet_name=None, index_col=0, engine="openpyxl")
+    tables = {name.split("_")[0].lower(): sheet for name, sheet in sheets.items()}
+    return long_table(tables, key["participant_id"], key["researcher_initials"], key["date"])
+
+class GroupIndex:
+    '''
+    Index of the processed result files that are in the group table. update() only loads the files
+    that are new or changed since the last update, and drops the rows of the files that are gone.
+    '''
+    def __init__(self, results_folder: Path = None, group_folder: Path = None):
+        self.results_folder = Path(results_folder) if results_folder else processed_folder()
+        self.group_folder = Path(group_folder) if group_folder else self.results_folder / "group"
+        self.index_path = self.group_folder / "index.csv"
+        self.table_path = self.group_folder / "group_long.parquet"
+
+    def sources(self) -> pd.DataFrame:
+        '''
+        The result files in results_folder, one per participant run. A long table is preferred over
+        the Excel file of the same run (which may have the old .csv name). The key of a long table is
+        read from its own columns, that of an Excel file from its name.
+        '''
+        rows, skipped = [], []
+        for path in sorted(self.results_folder.glob("processed_data_*")):
+            match = FILE_NAME.match(path.stem)
+            if match is None or path.suffix not in (".parquet", ".xlsx", ".csv"):
+                if any(path.name.startswith(f"processed_data_{result_type}_") for result_type in RESULT_TYPES):
+                    print(f"Warning: {path.name} is not in the group table, its name has no participant ID, initials and date")
+                else:
+                    skipped.append(path.name)  # other outputs, e.g. the HRV per event
+                continue
+            key = {column: match[column] for column in KEY_COLUMNS}
+            if match["type"] == "long":
+                key = _long_table_key(path) or key
+            stat = path.stat()
+            rows.append({"source": path.name, "type": match["type"], "mtime_ns": stat.st_mtime_ns, "size": stat.st_size, **key})
+        if skipped:
+            print(f"Not result tables, skipped: {', '.join(skipped)}")
+        sources = pd.DataFrame(rows, columns=["source", "type", "mtime_ns", "size"] + KEY_COLUMNS)
+        # "long" sorts before "excel_table" in reverse order, keep one file per run
+        sources = sources.sort_values("type", ascending=False).drop_duplicates(KEY_COLUMNS)
+        return sources.sort_values(KEY_COLUMNS, ignore_index=True)
+
+    def load(self) -> pd.DataFrame:
+        return pd.read_parquet(self.table_path) if self.table_path.exists() else None
+
+    def update(self, rebuild: bool = False) -> pd.DataFrame:
+        sources = self.sources()
+        previous = pd.read_csv(self.index_path, dtype=str) if self.index_path.exists() and not rebuild else None
+        table = self.load() if previous is not None else None
+
+        if previous is not None and table is not None:
+            merged = sources.astype(str).merge(previous, how="outer", indicator=True)
+            # Rows only in sources are new or changed files, rows only in the index are changed or removed files
+            to_load = sources[sources["source"].isin(merged.loc[merged["_merge"] == "left_only", "source"])]
+            stale = set(merged.loc[merged["_merge"] != "both", "source"])
+            table = table[~table["source"].isin(stale)]
+        else:
+            to_load = sources
+            table = None
+
+        new_rows = []
+        long_files = to_load[to_load["type"] == "long"]
+        if not long_files.empty:
+            # All new long tables are scanned as one Arrow dataset, each file keeps its name as source
+            dataset = ds.dataset([str(self.results_folder / source) for source in long_files["source"]], format="parquet")
+            for fragment in dataset.get_fragments():
+                rows = fragment.to_table().to_pandas()
+                rows["source"] = Path(fragment.path).name
+                new_rows.append(rows)
+        for _, source in to_load[to_load["type"] == "excel_table"].iterrows():
+            rows = _read_excel_results(self.results_folder / source["source"], source)
+            rows["source"] = source["source"]
+            new_rows.append(rows)
+        print(f"Group table: {len(to_load)} new or changed result files, {len(sources) - len(to_load)} unchanged")
+
+        frames = [frame for frame in [table] + new_rows if frame is not None and not frame.empty]
+        table = pd.concat(frames, ignore_index=True) if frames else long_table({}, None, None, None).assign(source=None)
+        if not self.group_folder.exists():
+            self.group_folder.mkdir(parents=True)
+        table.to_parquet(self.table_path, compression="zstd", index=False)
+        sources.to_csv(self.index_path, index=False)
+        return table
+
+def condition_statistics(table: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Per modality, feature and condition: the mean, SD, SEM and number of participants. Repeated
+    blocks of a condition are averaged within each participant first.
+    '''
+    per_participant = table.groupby(["modality", "feature", "condition"] + KEY_COLUMNS, sort=False)["value"].mean()
+    grouped = per_participant.groupby(level=["modality", "feature", "condition"], sort=False)
+    statistics = grouped.agg(["mean", "std", "count"])
+    statistics["sem"] = statistics["std"] / np.sqrt(statistics["count"])
+    return statistics.reset_index()
+
+def plot_group_bars(table: pd.DataFrame, statistics: pd.DataFrame, figures_folder: Path, features: dict = None):
+    '''
+    One bar graph per feature: the group mean of every condition with its SEM, and each participant as a dot.
+    '''
+    features = features or IMPORTANT_FEATURES
+    if not figures_folder.exists():
+        figures_folder.mkdir(parents=True)
+    per_participant = table.groupby(["modality", "feature", "condition"] + KEY_COLUMNS, sort=False)["value"].mean().reset_index()
+
+    for modality, modality_features in features.items():
+        for feature in modality_features:
+            feature_statistics = statistics[(statistics["modality"] == modality) & (statistics["feature"] == feature)]
+            if feature_statistics.empty:
+                print(f"No results for {feature}")
+                continue
+            conditions = feature_statistics["condition"].tolist()
+            positions = np.arange(len(conditions))
+
+            plt.figure(figsize=(14, 8))
+            plt.bar(positions, feature_statistics["mean"], yerr=feature_statistics["sem"], capsize=5, alpha=0.7)
+            points = per_participant[(per_participant["modality"] == modality) & (per_participant["feature"] == feature)]
+            point_positions = points["condition"].map(dict(zip(conditions, positions)))
+            plt.scatter(point_positions, points["value"], color="black", s=12, zorder=3)
+            plt.xticks(positions, conditions, rotation=45)
+            plt.xlabel('Conditions')
+            plt.ylabel(feature)
+            plt.title(f"{feature} per condition (n = {points[KEY_COLUMNS].drop_duplicates().shape[0]})")
+            plt.tight_layout()
+            plt.savefig(figures_folder / f"group_{feature}_{modality}.png")
+            plt.close()
+
+def main(rebuild: bool = False, results_folder: Path = None):
+    print("Updating group analysis...")
+    group_index = GroupIndex(results_folder)
+    table = group_index.update(rebuild)
+    if table.empty:
+        print("No processed results to analyse.")
+        return None
+
+    statistics = condition_statistics(table)
+    statistics_path = group_index.group_folder / "group_statistics.csv"
+    statistics.to_csv(statistics_path, index=False)
+    print(f"Group statistics saved at {statistics_path}")
+
+    script_dir = Path(__file__).resolve().parent.parent
+    figures_folder = script_dir.parent / "reports" / "figures" / "group"
+    plot_group_bars(table, statistics, figures_folder)
+    print(f"Group plots saved at {figures_folder}")
+    return statistics
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Aggregate the processed results of all participants.")
+    parser.add_argument("--rebuild", action="store_true", help="Reload every result file instead of only the new ones")
+    parser.add_argument("--results-folder", type=Path, help="Folder of the processed results (default data/processed)")
+    args = parser.parse_args()
+    main(args.rebuild, args.results_folder)
@@ -0,0 +1,216 @@
+''' Headless batch processing of many recordings on a process pool.
+
+Runs make_dataset -> build_features -> visualize for every recording listed in a manifest
+(or matched by a glob) without opening the GUI. Failures are reported per recording and do
+not stop the rest of the batch.
+
+    python src/batch.py --manifest manifest.csv --workers 8 --excel-table --rates-and-events
+    python src/batch.py --glob "data/external/*.mat" --sampling-rate 2000 --initials OG
+
+Every recording gets a run_report.json with per-stage timings in its interim folder, --profile
+also writes a cProfile dump per stage next to it. The stages are checkpointed per recording (see
+pipeline.py), so rerunning a batch after a fix only recomputes the stages affected by it.
+
+The manifest is a CSV with the columns data_file, sampling_rate, researcher_initials and
+participant_name (participant_id is optional, otherwise it is derived from the participant name,
+the file name for --glob, so reruns reuse the same ID and checkpoints).
+sampling_rate can be left empty for .acq files, which carry their native rate. An optional
+protocol column selects the study's protocol per recording (see features/protocols), so
+recordings of different studies can be processed in one batch. With --excel-table --group the
+group analysis (analysis/group_analysis.py) is updated with the new results after the batch.
+'''
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+import traceback
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import matplotlib
+matplotlib.use("Agg")  # workers have no display, plt.show() becomes a no-op
+import matplotlib.pyplot as plt
+
+from participants import stable_participant_id
+from read.storage import FORMATS, DEFAULT_FORMAT
+from features.build_features import interim_folder
+from features.cache import ProcessedSignalCache
+from features.protocol import DEFAULT_PROTOCOL
+from features.resample import DEFAULT_SAMPLING_RATES
+from features.windowed import FEATURE_WINDOW_SECONDS, FEATURE_STEP_SECONDS
+from pipeline import run_analysis, OUTPUT_FLAGS
+from analysis.group_analysis import main as group_analysis
+from profiling import StageProfiler
+
+
+def read_manifest(manifest_path: Path, protocol: str = DEFAULT_PROTOCOL) -> list:
+    jobs = []
+    with open(manifest_path, newline="") as f:
+        for row in csv.DictReader(f):
+            jobs.append({
+                "data_file": row["data_file"],
+                "sampling_rate": int(row["sampling_rate"]) if row.get("sampling_rate") else None,
+                "researcher_initials": row["researcher_initials"],
+                "participant_name": row["participant_name"],
+                "participant_id": row.get("participant_id") or stable_participant_id(row["participant_name"]),
+                "protocol": row.get("protocol") or protocol,
+            })
+    return jobs
+
+
+def jobs_from_glob(pattern: str, sampling_rate: int, researcher_initials: str, protocol: str = DEFAULT_PROTOCOL) -> list:
+    jobs = []
+    for data_file in sorted(glob.glob(pattern)):
+        participant_name = Path(data_file).stem
+        jobs.append({
+            "data_file": data_file,
+            "sampling_rate": sampling_rate,
+            "researcher_initials": researcher_initials,
+            "participant_name": participant_name,
+            "participant_id": stable_participant_id(participant_name),
+            "protocol": protocol,
+        })
+    return jobs
+
+
+def process_recording(job: dict, outputs: dict, modality_executor: str = None, file_format: str = DEFAULT_FORMAT,
+                      cache: ProcessedSignalCache = None, render_workers: int = 1, profile: bool = False,
+                      detect_events: bool = False, chunk_seconds: float = None, use_checkpoints: bool = True,
+                      sampling_rates: dict = None, feature_windows: tuple = None) -> dict:
+    '''
+    Run the whole pipeline for one recording. Never raises, the outcome is returned instead
+    so a single broken recording does not take down the batch.
+    '''
+    start = time.perf_counter()
+    result = dict(job, status="ok", error=None)
+    run_folder = interim_folder(job["researcher_initials"], job["participant_id"])
+    profiler = StageProfiler(run_folder / "profile" if profile else None)
+    try:
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message=".*non-interactive.*")
+            run_analysis(Path(job["data_file"]), job["sampling_rate"], job["researcher_initials"], job["participant_id"], outputs,
+                         protocol=job["protocol"], detect_events=detect_events, chunk_seconds=chunk_seconds, executor=modality_executor,
+                         file_format=file_format, cache=cache, headless=True, render_workers=render_workers, profiler=profiler,
+                         use_checkpoints=use_checkpoints, sampling_rates=sampling_rates, feature_windows=feature_windows)
+    except Exception:
+        result["status"] = "failed"
+        result["error"] = traceback.format_exc()
+    finally:
+        plt.close("all")  # workers are reused, don't keep every recording's figures alive
+        # Also saved for failed recordings, it shows how far they got
+        profiler.metadata.update(status=result["status"])
+        result["run_report"] = profiler.save(run_folder)
+    result["wall_time_s"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run_batch(jobs: list, outputs: dict, max_workers: int = None, modality_executor: str = None, file_format: str = DEFAULT_FORMAT,
+              cache: ProcessedSignalCache = None, render_workers: int = 1, profile: bool = False,
+              detect_events: bool = False, chunk_seconds: float = None, use_checkpoints: bool = True,
+              sampling_rates: dict = None, feature_windows: tuple = None) -> list:
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_recording, job, outputs, modality_executor, file_format, cache, render_workers, profile, detect_events, chunk_seconds,
+                                   use_checkpoints, sampling_rates, feature_windows): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                # The worker process itself died (e.g. out of memory)
+                result = dict(job, status="failed", error=traceback.format_exc(), wall_time_s=None)
+            print(f"[{result['status']}] {job['data_file']} ({result['wall_time_s']} s)")
+            if result["error"]:
+                print(result["error"])
+            results.append(result)
+    return results
+
+
+def save_report(results: list, report_path: Path):
+    fieldnames = ["data_file", "participant_name", "participant_id", "researcher_initials",
+                  "sampling_rate", "protocol", "status", "wall_time_s", "run_report", "error"]
+    with open(report_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Process many BIOPAC recordings without the GUI.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--manifest", type=Path, help="CSV with data_file, sampling_rate, researcher_initials, participant_name")
+    source.add_argument("--glob", help="Glob of recordings, e.g. 'data/external/*.mat' or 'data/external/*.acq'")
+    parser.add_argument("--sampling-rate", type=int, help="Sampling rate for --glob .mat recordings (.acq files use their own)")
+    parser.add_argument("--initials", help="Researcher initials for --glob recordings")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--modality-executor", choices=["thread", "process"],
+                        help="Also process the modalities and analyse the epochs of each recording in parallel")
+    parser.add_argument("--render-workers", type=int, default=1,
+                        help="Worker processes rendering the figures of each recording (1 renders them in the recording's worker)")
+    parser.add_argument("--output-format", choices=list(FORMATS), default=DEFAULT_FORMAT,
+                        help="File format of the raw and interim data")
+    parser.add_argument("--cache-dir", type=Path, help="Directory of the processed signal cache (default data/cache)")
+    parser.add_argument("--no-cache", action="store_true", help="Always rerun the NeuroKit processing")
+    parser.add_argument("--protocol", default=DEFAULT_PROTOCOL,
+                        help="Protocol name (in features/protocols) or file, for recordings without a manifest protocol column")
+    parser.add_argument("--detect-events", action="store_true",
+                        help="Take the event onsets from the 0/9 markers in the slider instead of the protocol's onsets")
+    parser.add_argument("--chunk-minutes", type=float,
+                        help="Process the signals in overlapping windows of this length, to bound the memory of long recordings")
+    parser.add_argument("--resample", nargs="+", metavar="MODALITY=HZ", default=[f"{signal_type}={rate}" for signal_type, rate in DEFAULT_SAMPLING_RATES.items()],
+                        help="Rates to resample modalities to before processing (default %(default)s), the others keep the acquisition rate")
+    parser.add_argument("--no-resample", action="store_true", help="Process every modality at the acquisition rate")
+    parser.add_argument("--no-checkpoints", action="store_true", help="Run every stage again instead of resuming from the checkpoints of earlier runs")
+    parser.add_argument("--feature-windows", nargs=2, type=float, metavar=("WINDOW", "STEP"), default=[FEATURE_WINDOW_SECONDS, FEATURE_STEP_SECONDS],
+                        help=f"Window and step in seconds of --windowed-features (default {FEATURE_WINDOW_SECONDS} {FEATURE_STEP_SECONDS})")
+    parser.add_argument("--report", type=Path, help="Write a per-recording CSV report to this path")
+    parser.add_argument("--profile", action="store_true", help="Write a cProfile dump per pipeline stage next to the run reports")
+    parser.add_argument("--group", action="store_true", help="Update the group analysis with the results of the batch (needs --excel-table)")
+    for flag in OUTPUT_FLAGS:
+        parser.add_argument(f"--{flag.lower().replace('_', '-')}", dest=flag, action="store_true")
+    args = parser.parse_args(argv)
+    if args.glob and args.initials is None:
+        parser.error("--glob requires --initials")
+    try:
+        args.sampling_rates = {} if args.no_resample else {modality: int(rate) for modality, rate in (item.split("=") for item in args.resample)}
+    except ValueError:
+        parser.error(f"--resample expects MODALITY=HZ, e.g. eda=100, got {args.resample}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.manifest:
+        jobs = read_manifest(args.manifest, args.protocol)
+    else:
+        jobs = jobs_from_glob(args.glob, args.sampling_rate, args.initials, args.protocol)
+    if not jobs:
+        print("No recordings to process.")
+        return 1
+
+    outputs = {flag: getattr(args, flag) for flag in OUTPUT_FLAGS}
+    print(f"Processing {len(jobs)} recordings on {args.workers} workers...")
+    start = time.perf_counter()
+    cache = None if args.no_cache else ProcessedSignalCache(args.cache_dir)
+    results = run_batch(jobs, outputs, args.workers, args.modality_executor, args.output_format, cache, args.render_workers, args.profile, args.detect_events,
+                        args.chunk_minutes * 60 if args.chunk_minutes else None, not args.no_checkpoints, args.sampling_rates,
+                        tuple(args.feature_windows))
+    total_time = time.perf_counter() - start
+
+    failed = [result for result in results if result["status"] != "ok"]
+    print(f"Batch complete in {total_time:.1f} s: {len(results) - len(failed)} succeeded, {len(failed)} failed")
+    for result in failed:
+        print(f"  failed: {result['data_file']}")
+    if args.report:
+        save_report(results, args.report)
+        print(f"Report saved at {args.report}")
+    if args.group:
+        group_analysis()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+''' Benchmarks of the pipeline on synthetic recordings.
+
+Every case (duration x sampling rate) runs make_dataset -> build_features -> visualize in a fresh
+worker process with a StageProfiler, so each stage's wall time, CPU time, peak RSS and bytes
+written are measured without real participant data. The results of a run are saved as JSON in
+reports/benchmarks and two runs can be compared stage by stage:
+
+    cd src
+    python -m benchmarks.benchmark run --durations 10 30 120 --sampling-rates 500 1000 2000 --name baseline
+    python -m benchmarks.benchmark compare ../reports/benchmarks/baseline.json ../reports/benchmarks/parquet.json
+'''
+import argparse
+import json
+import platform
+import subprocess
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from benchmarks.synthetic import main as generate_recording
+from read.make_dataset import main as make_dataset
+from read.storage import FORMATS, DEFAULT_FORMAT
+from features.build_features import main as build_features
+from features.resample import DEFAULT_SAMPLING_RATES
+from features.windowed import windowed_features
+from visualization.visualize import main as visualize
+from pipeline import plan, OUTPUT_FLAGS
+from profiling import StageProfiler
+
+RESEARCHER_INITIALS = "BM"
+DEFAULT_OUTPUTS = ["HRV", "slider", "rates_and_events"]
+
+def results_folder() -> Path:
+    script_dir = Path(__file__).resolve().parent.parent
+    return script_dir.parent / "reports" / "benchmarks"
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_case(data_file: Path, sampling_rate: int, outputs: list, executor: str = None, render_workers: int = 1,
+             file_format: str = DEFAULT_FORMAT) -> dict:
+    '''
+    Run the whole pipeline on one recording and return the profiler's report. The processed
+    signal cache is not used, the processing itself is what is measured. Like in the GUI, only the
+    channels and modalities the outputs need are loaded and processed, the slow ones resampled.
+    '''
+    profiler = StageProfiler()
+    participant_id = data_file.stem
+    signal_types, channels = plan({flag: True for flag in outputs})
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message=".*non-interactive.*")
+        df, sampling_rate = make_dataset(data_file, sampling_rate, RESEARCHER_INITIALS, participant_id,
+                                         channels=channels, file_format=file_format, profiler=profiler)
+        processed_dataframes, peaks, events = build_features(df, sampling_rate, RESEARCHER_INITIALS, participant_id,
+                                                             executor=executor, file_format=file_format, profiler=profiler,
+                                                             signal_types=signal_types, sampling_rates=DEFAULT_SAMPLING_RATES)
+        visualize(df, processed_dataframes, sampling_rate, RESEARCHER_INITIALS, participant_id, events,
+                  **{flag: flag in outputs for flag in OUTPUT_FLAGS if flag != "windowed_features"},
+                  executor=executor, headless=True, render_workers=render_workers, profiler=profiler, peaks=peaks,
+                  sampling_rates=DEFAULT_SAMPLING_RATES)
+        if "windowed_features" in outputs:
+            with profiler.stage("windowed_features"):
+                windowed_features(processed_dataframes, peaks, sampling_rate, DEFAULT_SAMPLING_RATES)
+    plt.close("all")
+    return profiler.report()
+
+def run(durations: list, sampling_rates: list, outputs: list, name: str = None, executor: str = None, render_workers: int = 1,
+        file_format: str = DEFAULT_FORMAT, ecg_method: str = "simple") -> Path:
+    settings = {"durations_min": durations, "sampling_rates": sampling_rates, "outputs": outputs, "executor": executor,
+                "render_workers": render_workers, "file_format": file_format, "ecg_method": ecg_method}
+    results = {
+        "name": name,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "machine": platform.node(),
+        "settings": settings,
+        "cases": [],
+    }
+    for duration in durations:
+        for sampling_rate in sampling_rates:
+            data_file = generate_recording(duration * 60, sampling_rate, ecg_method=ecg_method)
+            print(f"Benchmarking {data_file.name}...")
+            # A fresh process per case, so the peak memory of one case doesn't carry over to the next
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                report = pool.submit(run_case, data_file, sampling_rate, outputs, executor, render_workers, file_format).result()
+            results["cases"].append({"duration_min": duration, "sampling_rate": sampling_rate, **report})
+            print(f"{data_file.name} done in {report['total_wall_time_s']:.1f} s")
+
+    folder = results_folder()
+    if not folder.exists():
+        folder.mkdir(parents=True)
+    results_path = folder / f"{name or datetime.now().strftime('%Y_%m_%d_%H%M%S')}.json"
+    results_path.write_text(json.dumps(results, indent=2, default=str))
+    print(f"Benchmark results saved at {results_path}")
+    return results_path
+
+def _megabytes(n_bytes):
+    return f"{n_bytes / 1024 ** 2:.0f}" if n_bytes else "n/a"
+
+def _seconds(seconds):
+    return f"{seconds:.3f}" if seconds is not None else "n/a"
+
+def compare(baseline_path: Path, candidate_path: Path):
+    '''
+    Print the wall time and peak RSS of every stage of both runs, for the cases they have in common.
+    Metrics missing from a record (e.g. results of older versions) are shown as n/a.
+    '''
+    baseline = json.loads(Path(baseline_path).read_text())
+    candidate = json.loads(Path(candidate_path).read_text())
+    candidate_cases = {(case["duration_min"], case["sampling_rate"]): case for case in candidate["cases"]}
+
+    for baseline_case in baseline["cases"]:
+        case_key = (baseline_case["duration_min"], baseline_case["sampling_rate"])
+        if case_key not in candidate_cases:
+            continue
+        candidate_case = candidate_cases[case_key]
+        print(f"\n{case_key[0]} min at {case_key[1]} Hz")
+        print(f"{'stage':<28}{'wall (s)':>10}{'new (s)':>10}{'speedup':>9}{'RSS (MB)':>10}{'new (MB)':>10}")
+        candidate_stages = {stage["stage"]: stage for stage in candidate_case["stages"]}
+        for stage in baseline_case["stages"] + [{"stage": "total", "wall_time_s": baseline_case.get("total_wall_time_s"),
+                                                 "peak_rss_bytes": baseline_case.get("peak_rss_bytes")}]:
+            if stage["stage"] == "total":
+                new_stage = {"wall_time_s": candidate_case.get("total_wall_time_s"), "peak_rss_bytes": candidate_case.get("peak_rss_bytes")}
+            elif stage["stage"] in candidate_stages:
+                new_stage = candidate_stages[stage["stage"]]
+            else:
+                continue
+            wall_time, new_wall_time = stage.get("wall_time_s"), new_stage.get("wall_time_s")
+            speedup = f"{wall_time / new_wall_time:.2f}x" if wall_time is not None and new_wall_time else "n/a"
+            print(f"{stage['stage']:<28}{_seconds(wall_time):>10}{_seconds(new_wall_time):>10}{speedup:>9}"
+                  f"{_megabytes(stage.get('peak_rss_bytes')):>10}{_megabytes(new_stage.get('peak_rss_bytes')):>10}")
+        print(f"{'processed signals (MB)':<28}{_megabytes(baseline_case.get('processed_memory_bytes')):>10}"
+              f"{_megabytes(candidate_case.get('processed_memory_bytes')):>10}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic recordings.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks and save the results")
+    run_parser.add_argument("--durations", type=float, nargs="+", default=[10, 30, 120], help="Recording durations in minutes")
+    run_parser.add_argument("--sampling-rates", type=int, nargs="+", default=[500, 1000, 2000])
+    run_parser.add_argument("--outputs", nargs="+", choices=OUTPUT_FLAGS, default=DEFAULT_OUTPUTS, help="Figures and tables to produce")
+    run_parser.add_argument("--name", help="Name of the results file (default: the current time)")
+    run_parser.add_argument("--executor", choices=["thread", "process"], help="Executor for the modalities and epochs")
+    run_parser.add_argument("--render-workers", type=int, default=1)
+    run_parser.add_argument("--output-format", choices=list(FORMATS), default=DEFAULT_FORMAT)
+    run_parser.add_argument("--ecg-method", choices=["simple", "ecgsyn"], default="simple", help="NeuroKit ECG simulator")
+    compare_parser = subparsers.add_parser("compare", help="Compare two results files stage by stage")
+    compare_parser.add_argument("baseline", type=Path)
+    compare_parser.add_argument("candidate", type=Path)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args.durations, args.sampling_rates, args.outputs, args.name, args.executor, args.render_workers,
+            args.output_format, args.ecg_method)
+    else:
+        compare(args.baseline, args.candidate)
@@ -0,0 +1,88 @@
+''' Synthetic BIOPAC-shaped recordings for the benchmarks.
+
+The .mat files have the same layout as the AcqKnowledge exports (data, labels, units) and the
+channel labels and units of COLUMN_LABELS, so they go through the pipeline like a real recording.
+The signals are simulated with NeuroKit, the slider jumps between 0 and 9 at the onsets of the
+BAK protocol like the experimenters did to mark the start of a stimulus.
+'''
+import re
+from pathlib import Path
+import numpy as np
+import neurokit2 as nk
+from scipy.io import savemat
+from features.build_features import COLUMN_LABELS
+from features.protocol import load_protocol, DEFAULT_PROTOCOL
+
+def _split_label(column_label: str):
+    # "ECG100C (mV)" -> ("ECG100C", "mV")
+    label, unit = re.fullmatch(r"(.*) \((.*)\)", column_label).groups()
+    return label, unit
+
+def simulate_slider(n_samples: int, sampling_rate: int, rng: np.random.Generator, marker_seconds: float = 2.0,
+                    protocol: str = DEFAULT_PROTOCOL):
+    # A rating held for 10-40 s at a time, with 0/9 bursts at the protocol onsets
+    slider = np.empty(n_samples)
+    start = 0
+    while start < n_samples:
+        end = start + int(rng.uniform(10, 40) * sampling_rate)
+        slider[start:end] = rng.integers(1, 9)
+        start = end
+
+    burst_length = int(marker_seconds * sampling_rate)
+    toggle_length = max(1, sampling_rate // 4)
+    pattern = np.where((np.arange(burst_length) // toggle_length) % 2 == 0, 0, 9)
+    for onset in load_protocol(protocol).onsets:
+        begin = int(onset * sampling_rate)
+        if begin >= n_samples:
+            break
+        end = min(begin + burst_length, n_samples)
+        slider[begin:end] = pattern[:end - begin]
+    return slider
+
+def simulate_recording(duration: float, sampling_rate: int, heart_rate: float = 70, respiratory_rate: float = 15,
+                       ecg_method: str = "simple", random_state: int = 42) -> np.ndarray:
+    '''
+    Simulate duration seconds of EDA, RSP, ECG, PPG and slider, in the column order of COLUMN_LABELS.
+    ecg_method="ecgsyn" is more realistic but takes minutes for long recordings.
+    '''
+    n_samples = int(duration * sampling_rate)
+    rng = np.random.default_rng(random_state)
+    # Not every simulator honours length (ppg_simulate has none), so whole seconds are simulated and cut to size below
+    seconds = int(np.ceil(duration))
+    signals = {
+        'eda': nk.eda_simulate(duration=seconds, sampling_rate=sampling_rate, scr_number=max(1, seconds // 30),
+                               drift=-0.001, random_state=random_state),
+        'rsp': nk.rsp_simulate(duration=seconds, sampling_rate=sampling_rate, respiratory_rate=respiratory_rate,
+                               random_state=random_state),
+        'ecg': nk.ecg_simulate(duration=seconds, sampling_rate=sampling_rate, heart_rate=heart_rate, method=ecg_method,
+                               random_state=random_state),
+        'ppg': nk.ppg_simulate(duration=seconds, sampling_rate=sampling_rate, heart_rate=heart_rate,
+                               random_state=random_state),
+        'slider': simulate_slider(n_samples, sampling_rate, rng),
+    }
+    data = np.empty((n_samples, len(COLUMN_LABELS)))
+    for i, signal_type in enumerate(COLUMN_LABELS):
+        data[:, i] = np.asarray(signals[signal_type])[:n_samples]
+    return data
+
+def recording_name(duration: float, sampling_rate: int) -> str:
+    return f"synthetic_{duration / 60:g}min_{sampling_rate}Hz"
+
+def save_recording(data: np.ndarray, path: Path) -> Path:
+    labels, units = zip(*(_split_label(column_label) for column_label in COLUMN_LABELS.values()))
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True)
+    savemat(path, {"data": data, "labels": np.array(labels), "units": np.array(units)})
+    return path
+
+def main(duration: float, sampling_rate: int, output_folder: Path = None, ecg_method: str = "simple", overwrite: bool = False) -> Path:
+    '''
+    Generate (or reuse) the synthetic recording for duration seconds at sampling_rate and return its path.
+    '''
+    script_dir = Path(__file__).resolve().parent.parent
+    output_folder = output_folder or script_dir.parent / "data" / "external" / "synthetic"
+    path = output_folder / f"{recording_name(duration, sampling_rate)}.mat"
+    if path.exists() and not overwrite:
+        return path
+    print(f"Simulating {path.name}...")
+    return save_recording(simulate_recording(duration, sampling_rate, ecg_method=ecg_method), path)
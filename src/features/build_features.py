@@ -1,121 +1,323 @@
+import json
 import neurokit2 as nk
 import pandas as pd
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from read.storage import save_dataframe, load_dataframe, find_saved, DEFAULT_FORMAT
+from read.dtypes import compact, memory_bytes, megabytes, SIGNAL_DTYPE
+from features.cache import ProcessedSignalCache, source_hash
+from features.protocol import load_protocol, DEFAULT_PROTOCOL
+from features import event_detection
+from features.chunked import process_chunked, DEFAULT_OVERLAP_SECONDS
+from features.peak_index import split_markers, save_peaks, load_peaks
+from features.resample import resample, modality_rate
+from profiling import NullProfiler, timed
+
+EXECUTORS = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+
+# BIOPAC channel ("label (unit)") used for each modality
+COLUMN_LABELS = {
+        "eda": "EDA100C (microsiemens)",
+        "rsp": "RSP100C (Volts)",
+        "ecg": "ECG100C (mV)",
+        "ppg": "Status, OXY100C (Status)",
+        "slider": "Slider - TSD115 - Psychological assessment, AMI / HLT - A15 (number)"
+    }
+
+# NeuroKit processing function of each modality, the slider is only filtered
+PROCESS_FUNCS = {'ecg': nk.ecg_process, 'rsp': nk.rsp_process, 'eda': nk.eda_process, 'ppg': nk.ppg_process}
+# Modules whose code changes the processed signals, a fix in any of them invalidates the cached signals
+PROCESSING_MODULES = ["features.build_features", "features.chunked", "features.resample", "features.peak_index", "read.dtypes"]
+
+def _run_process(process_func, signal, sampling_rate):
+    # Module level so it can be pickled and sent to a worker process. Compacted where it runs,
+    # so workers send back the smaller DataFrame
+    processed_signals, _ = process_func(signal, sampling_rate)
+    return compact(processed_signals)
 
 class FeatureBuilder:
     def __init__(self, 
                  df: pd.DataFrame, 
                  sampling_rate: int, 
-                 column_labels: dict = None):
+                 column_labels: dict = None,
+                 cache: ProcessedSignalCache = None,
+                 data_file: Path = None,
+                 profiler=None,
+                 protocol: str = DEFAULT_PROTOCOL,
+                 detect_events: bool = False,
+                 chunk_seconds: float = None,
+                 overlap_seconds: float = DEFAULT_OVERLAP_SECONDS,
+                 sampling_rates: dict = None):
         self.df = df
         self.sampling_rate = sampling_rate
         self.column_labels = column_labels
+        # Processed signals are cached per recording file, so both are needed to use the cache
+        self.cache = cache if data_file is not None else None
+        self.data_file = data_file
+        self.profiler = profiler or NullProfiler()
+        # Name of a file in features/protocols or path to a protocol file, see features.protocol
+        self.protocol = load_protocol(protocol)
+        # Take the event onsets from the markers in the slider instead of the protocol's onsets
+        self.detect_events = detect_events
+        # Process long recordings in windows of chunk_seconds (overlapping by overlap_seconds) to bound the memory
+        self.chunk_seconds = chunk_seconds
+        self.overlap_seconds = overlap_seconds
+        # Target rate of each modality ({modality: Hz}, see features.resample), the others keep the acquisition rate
+        self.sampling_rates = sampling_rates
+
+    def rate(self, signal_type: str) -> int:
+        return modality_rate(self.sampling_rate, self.sampling_rates, signal_type)
 
-    def _process(self, process_func, column_label):
-        processed_signals, _ = process_func(self.df[column_label], self.sampling_rate)
-        return processed_signals
+    def _signal(self, signal_type: str) -> pd.Series:
+        # The channel of a modality at the rate it is processed at
+        signal = self.df[self.column_labels[signal_type]]
+        if self.rate(signal_type) == self.sampling_rate:
+            return signal
+        return pd.Series(resample(signal.to_numpy(), self.sampling_rate, self.rate(signal_type)), name=signal.name)
+
+    def _process(self, process_func, signal_type):
+        return _run_process(process_func, self._signal(signal_type), self.rate(signal_type))
+
+    def _processing_params(self, signal_type: str, process_func) -> dict:
+        # Everything that changes the processed output of a modality goes into its cache key
+        params = {
+            "signal_type": signal_type,
+            "column_label": self.column_labels[signal_type],
+            "sampling_rate": self.sampling_rate,
+            "function": process_func.__name__,
+            "neurokit": nk.__version__,
+            "signal_dtype": str(self.df[self.column_labels[signal_type]].dtype),
+            "code": {module_name: source_hash(module_name) for module_name in PROCESSING_MODULES},
+        }
+        if self.chunk_seconds:
+            params.update(chunk_seconds=self.chunk_seconds, overlap_seconds=self.overlap_seconds)
+        if self.rate(signal_type) != self.sampling_rate:
+            params.update(processing_rate=self.rate(signal_type))
+        return params
 
     def _process_slider(self):
         column_label = self.column_labels['slider']
         if column_label in self.df.columns:
-            slider_scores = self.df[column_label]
+            slider_scores = self._signal('slider')
             filtered_signal = nk.signal_filter(slider_scores, 
                                                method="savgol", 
-                                               sampling_rate=self.sampling_rate, 
+                                               sampling_rate=self.rate('slider'), 
                                                lowcut=0.1, 
                                                highcut=None)
-            return pd.DataFrame({'slider': filtered_signal})
+            return pd.DataFrame({'slider': filtered_signal.astype(SIGNAL_DTYPE)})
         return None
 
-    def process_signals(self):
+    def process_signals(self, executor: str = None, max_workers: int = None, signal_types: list = None):
+        '''
+        Process every modality (or only signal_types) with NeuroKit. The modalities are independent, so with
+        executor="thread" or executor="process" they run at the same time on a worker pool
+        instead of one after another (ECG usually dominates the runtime).
+        '''
+        signal_types = signal_types or list(self.column_labels)
+        process_funcs = {signal_type: process_func for signal_type, process_func in PROCESS_FUNCS.items() if signal_type in signal_types}
         processed_dataframes = {}
-        for signal_type, process_func in zip(['ecg', 'rsp', 'eda', 'ppg'], 
-                                             [nk.ecg_process, nk.rsp_process, nk.eda_process, nk.ppg_process]):
-            if self.column_labels[signal_type] == nk.rsp_process:
-                processed_dataframes[signal_type] = self._process(process_func, self.column_labels[signal_type])
-            else:    
-                processed_dataframes[signal_type] = self._process(process_func, self.column_labels[signal_type])
-        
-        processed_dataframes['slider'] = self._process_slider()
-
-        events = self._create_events()
-
-        return processed_dataframes, events
-
-    def _create_events(self):
-
-        # in order to find the seconds of the events, i looked at the recording, and found the seconds of the events manually
-        # to find the start of the stimulus, i looked at when the slider scale was changing between non absorptive to jumps between 0 to 9 (we used it as indicator for the start\end of the stimulus)
-        # I went to the preprocessed data file, then to the slider, chagned the view of the column to conditional formatting, scrolled down and found it at 712,549
-
-
-        '''8_OG_pilot_tobii_biopac'''
-        #8_OG_pilot_tobii_biopac experiment procedure event labels - abs 7 min, silence 3 min, "PCI" 1~ min, self-chosen-abs 7 min, silence 3 minu, "PCI" 1~ min
-        #event_labels = ["Absorptive", "1stSilence", "1stPCI", "Self-Chosen Absorptive", "2ndSilence", "2ndPCI", "Self-Chosen Non-absorptive", "3rdSilence"]
-        #8_OG_pilot_tobii_biopac experiment events onesets in seconds (around 30 minutes of recording - 1800~ seconds/ 60 seconds = 30 minutes)
-        #event_onsets_seconds = [0, 420, 605.34, 638.736, 1057.152, 1237.152, 1261.068, 1679.976] #until the end of 3rd silence, no 3rd PCI in the end
-
-        '''6_BAK_pilot_tobii_biopac'''
-        #event labels of 6_BAK_pilot_tobii_biopac experiment procedure - silence 5 minutes, abs 10 min, "PCI" around 1 minute, non-abs 10 min, silence 5 minutes
-        event_labels = ["1stSilence", "1stPCI", "Self-Chosen Non-absorptive", "2ndPCI", "Self-Chosen Absorptive", "3rdPCI", "2ndSilence", "4thPCI"]
-        #6_BAK_pilot_tobii_biopac experiment events onesets in seconds
-        event_onsets_seconds = [56.2, 356.2, 403.2, 1003.2, 1039.2, 1639.2, 1693.2, 1993.2]
-
-        event_labels_unique = [f"{label}_{i+1}" for i, label in enumerate(event_labels)]
-
-        # convert time from seconds to indices
-        event_onsets_indices = [int(i * self.sampling_rate) for i in event_onsets_seconds] 
-        return nk.events_create(event_onsets=event_onsets_indices, event_labels=event_labels_unique)
- 
-    def save2path(self, df: pd.DataFrame, researcher_initials: str, participant_id: str, feature_type: str):
-        current_date = datetime.now().strftime("%Y_%m_%d")
-        
-        # Create a folder name with initials, id and date
-        folder_name = f"{researcher_initials}_{participant_id}_{current_date}"
-        
-        script_dir = Path(__file__).resolve().parent.parent
-        data_folder = script_dir.parent / "data" / "interim" / folder_name
-        
-        # Create a new folder if it does not exist
-        if not data_folder.exists():
-            data_folder.mkdir(parents=True)
-        
-        # Generate Excel file name based on feature_type
-        excel_file_name = f"intermediate_data_{feature_type}.csv"
-        
-        # Create complete Excel path
-        excel_path = data_folder / excel_file_name
-        
-        # Save the DataFrame to CSV
-        df.to_csv(excel_path)
-        
-        return excel_path
-
-def main(df: pd.DataFrame, sampling_rate: int, researcher_initials: str, participant_id: str):
-    print("Building features...")
+
+        cache_keys = {}
+        if self.cache is not None:
+            for signal_type, process_func in process_funcs.items():
+                cache_keys[signal_type] = self.cache.key(self.data_file, self._processing_params(signal_type, process_func))
+                cached_df = self.cache.load(cache_keys[signal_type])
+                if cached_df is not None:
+                    print(f"{signal_type} loaded from cache")
+                    processed_dataframes[signal_type] = cached_df
+        to_process = {signal_type: process_func for signal_type, process_func in process_funcs.items()
+                      if signal_type not in processed_dataframes}
+
+        if executor is not None and executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor: {executor}, expected one of {list(EXECUTORS)}")
+
+        # Each modality is timed where it runs (worker thread or process) and recorded afterwards
+        if self.chunk_seconds and to_process:
+            # One modality at a time with its windows spread over the pool, so only a few windows are in memory
+            pool = EXECUTORS[executor](max_workers=max_workers) if executor else None
+            try:
+                for signal_type, process_func in to_process.items():
+                    processed_dataframes[signal_type], wall_time, cpu_time = timed(
+                        process_chunked, process_func, self._signal(signal_type), self.rate(signal_type),
+                        self.chunk_seconds, self.overlap_seconds, pool)
+                    self.profiler.record(f"process_{signal_type}", wall_time_s=wall_time, cpu_time_s=cpu_time, chunked=True)
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+        elif executor is None or not to_process:
+            for signal_type, process_func in to_process.items():
+                processed_dataframes[signal_type], wall_time, cpu_time = timed(self._process, process_func, signal_type)
+                self.profiler.record(f"process_{signal_type}", wall_time_s=wall_time, cpu_time_s=cpu_time)
+        else:
+            with EXECUTORS[executor](max_workers=max_workers or len(to_process)) as pool:
+                # Only the channel is sent to the worker, not the whole recording
+                futures = {signal_type: pool.submit(timed, _run_process, process_func, self._signal(signal_type), self.rate(signal_type))
+                           for signal_type, process_func in to_process.items()}
+                for signal_type, future in futures.items():
+                    processed_dataframes[signal_type], wall_time, cpu_time = future.result()
+                    self.profiler.record(f"process_{signal_type}", wall_time_s=wall_time, cpu_time_s=cpu_time, executor=executor)
+
+        if self.cache is not None:
+            for signal_type in to_process:
+                self.cache.save(cache_keys[signal_type], processed_dataframes[signal_type])
+
+        # Keep the usual modality order whatever came from the cache
+        processed_dataframes = {signal_type: processed_dataframes[signal_type] for signal_type in process_funcs}
+        if 'slider' in signal_types:
+            processed_dataframes['slider'], wall_time, cpu_time = timed(self._process_slider)
+            self.profiler.record("process_slider", wall_time_s=wall_time, cpu_time_s=cpu_time)
+
+        # The 0/1 marker columns are replaced by the sorted indices of their peaks (see features.peak_index)
+        peaks = {}
+        for signal_type, processed_df in processed_dataframes.items():
+            if processed_df is not None:
+                processed_dataframes[signal_type], peaks[signal_type] = split_markers(processed_df)
+                n_bytes = memory_bytes(processed_dataframes[signal_type]) + sum(indices.nbytes for indices in peaks[signal_type].values())
+                # What the same columns would take as dense float64, NeuroKit's default
+                print(f"{signal_type} signals use {megabytes(n_bytes)} ({megabytes(processed_df.size * 8)} in float64)")
+        # A field of the run report (and of each benchmark case), not a stage: it has no timings
+        self.profiler.metadata["processed_memory_bytes"] = (sum(memory_bytes(processed_df) for processed_df in processed_dataframes.values())
+                                                            + sum(indices.nbytes for modality_peaks in peaks.values() for indices in modality_peaks.values()))
+
+        events = self.create_events()
+
+        return processed_dataframes, peaks, events
+
+    def process_signal(self, signal_type: str, pool=None):
+        '''
+        Process a single modality, e.g. as one stage of pipeline.py, and return its continuous columns and
+        marker indices. With a pool (thread or process pool executor) NeuroKit runs on it, a chunked
+        recording spreads its windows over it.
+        '''
+        if signal_type == 'slider':
+            slider_df = self._process_slider()
+            return split_markers(slider_df) if slider_df is not None else (None, {})
+
+        process_func = PROCESS_FUNCS[signal_type]
+        cache_key = self.cache.key(self.data_file, self._processing_params(signal_type, process_func)) if self.cache is not None else None
+        processed_df = self.cache.load(cache_key) if cache_key else None
+        if processed_df is not None:
+            print(f"{signal_type} loaded from cache")
+            return split_markers(processed_df)
+
+        signal, rate = self._signal(signal_type), self.rate(signal_type)
+        if self.chunk_seconds:
+            processed_df = process_chunked(process_func, signal, rate, self.chunk_seconds, self.overlap_seconds, pool)
+        elif pool is not None:
+            processed_df = pool.submit(_run_process, process_func, signal, rate).result()
+        else:
+            processed_df = _run_process(process_func, signal, rate)
+        if cache_key:
+            self.cache.save(cache_key, processed_df)
+        return split_markers(processed_df)
+
+    def create_events(self):
+        # The event labels and onsets of the study come from its protocol file
+        slider_label = self.column_labels['slider']
+        if self.detect_events and slider_label in self.df.columns:
+            return event_detection.detect_events(self.df[slider_label].to_numpy(), self.sampling_rate, self.protocol)
+        return self.protocol.events(self.sampling_rate, len(self.df))
+
+    def save2path(self, df: pd.DataFrame, researcher_initials: str, participant_id: str, feature_type: str, file_format: str = DEFAULT_FORMAT):
+        return save_intermediate(df, researcher_initials, participant_id, feature_type, file_format)
+
+def save_intermediate(df: pd.DataFrame, researcher_initials: str, participant_id: str, feature_type: str, file_format: str = DEFAULT_FORMAT):
+    data_folder = interim_folder(researcher_initials, participant_id)
     
-    column_labels = {
-            "eda": "EDA100C (microsiemens)",
-            "rsp": "RSP100C (Volts)",
-            "ecg": "ECG100C (mV)",
-            "ppg": "Status, OXY100C (Status)",
-            "slider": "Slider - TSD115 - Psychological assessment, AMI / HLT - A15 (number)"
-        }
+    # Create a new folder if it does not exist
+    if not data_folder.exists():
+        data_folder.mkdir(parents=True)
+    
+    # Generate file name based on feature_type, the suffix comes from the file format
+    excel_file_name = f"intermediate_data_{feature_type}"
+    
+    # Create complete path
+    excel_path = data_folder / excel_file_name
+    
+    return save_dataframe(df, excel_path, file_format)
 
-    builder = FeatureBuilder(df, sampling_rate, column_labels)
-    intermediate_dataframes, _ = builder.process_signals()
+def interim_folder(researcher_initials: str, participant_id: str, current_date: str = None) -> Path:
+    current_date = current_date or datetime.now().strftime("%Y_%m_%d")
+    
+    # Create a folder name with initials, id and date
+    folder_name = f"{researcher_initials}_{participant_id}_{current_date}"
+    
+    script_dir = Path(__file__).resolve().parent.parent
+    return script_dir.parent / "data" / "interim" / folder_name
+
+def load_intermediate(researcher_initials: str, participant_id: str, current_date: str = None, feature_types: list = None) -> dict:
+    '''
+    Load the intermediate DataFrames saved by main back into a processed_dataframes dict.
+    current_date is the "%Y_%m_%d" date of the run (today by default).
+    '''
+    data_folder = interim_folder(researcher_initials, participant_id, current_date)
+    intermediate_dataframes = {}
+    for feature_type in feature_types or list(COLUMN_LABELS):
+        path = find_saved(data_folder / f"intermediate_data_{feature_type}")
+        if path is not None:
+            intermediate_dataframes[feature_type] = load_dataframe(path)
+    return intermediate_dataframes
 
+def load_intermediate_peaks(researcher_initials: str, participant_id: str, current_date: str = None, feature_types: list = None) -> dict:
+    '''
+    Load the peak indices saved by main back into a {feature type: {marker name: indices}} dict.
+    '''
+    data_folder = interim_folder(researcher_initials, participant_id, current_date)
+    peaks = {}
+    for feature_type in feature_types or list(COLUMN_LABELS):
+        path = data_folder / f"intermediate_peaks_{feature_type}.npz"
+        peaks[feature_type] = load_peaks(path) if path.exists() else {}
+    return peaks
+
+def save_features(intermediate_dataframes: dict, peaks: dict, events: dict, sampling_rate: int, researcher_initials: str, participant_id: str, file_format: str = DEFAULT_FORMAT, profiler=None, sampling_rates: dict = None):
+    '''
+    Save the processed signals, their peak indices and the events in the interim folder of the run,
+    with the rate of every modality in sampling_rates.json (the events are at the acquisition rate). The
+    rates of the modalities saved by earlier runs in the same folder are kept.
+    '''
+    profiler = profiler or NullProfiler()
     # Save each DataFrame from the intermediate_dataframes dictionary
     for key, intermediate_df in intermediate_dataframes.items():
         if intermediate_df is not None:  # Check if DataFrame is empty or None
-            file_path = builder.save2path(intermediate_df, researcher_initials, participant_id, key)
+            with profiler.stage(f"save_{key}") as stage:
+                file_path = save_intermediate(intermediate_df, researcher_initials, participant_id, key, file_format)
+                stage["bytes_written"] += file_path.stat().st_size
+                if peaks[key]:
+                    peaks_path = save_peaks(peaks[key], file_path.parent / f"intermediate_peaks_{key}")
+                    stage["bytes_written"] += peaks_path.stat().st_size
             print(f"{key} features saved at {file_path}")
+
+    # The events used for the epochs, to check the detected onsets against the recording
+    events_path = interim_folder(researcher_initials, participant_id) / "events.csv"
+    event_detection.events_table(events, sampling_rate).to_csv(events_path, index=False)
+    print(f"Events saved at {events_path}")
+    # Merged with the rates of the earlier runs of the day, whose files of the other modalities are still in the folder
+    rates_path = events_path.parent / "sampling_rates.json"
+    rates = json.loads(rates_path.read_text()) if rates_path.exists() else {}
+    rates.update({"acquisition": sampling_rate, **{signal_type: modality_rate(sampling_rate, sampling_rates, signal_type)
+                                                   for signal_type, intermediate_df in intermediate_dataframes.items() if intermediate_df is not None}})
+    rates_path.write_text(json.dumps(rates, indent=2))
+
+def main(df: pd.DataFrame, sampling_rate: int, researcher_initials: str, participant_id: str, executor: str = None, max_workers: int = None, column_labels: dict = None, file_format: str = DEFAULT_FORMAT, data_file: Path = None, cache: ProcessedSignalCache = None, profiler=None, protocol: str = DEFAULT_PROTOCOL, detect_events: bool = False, chunk_seconds: float = None, signal_types: list = None, sampling_rates: dict = None):
+    '''
+    Process the modalities (all of them, or only signal_types) and save them with the events in the interim folder.
+    sampling_rates are the target rates of the modalities to resample before processing (see features.resample).
+    '''
+    print("Building features...")
     
-    events = builder._create_events()
+    column_labels = column_labels or COLUMN_LABELS
+    profiler = profiler or NullProfiler()
+
+    builder = FeatureBuilder(df, sampling_rate, column_labels, cache, data_file, profiler, protocol, detect_events, chunk_seconds,
+                             sampling_rates=sampling_rates)
+    with profiler.stage("process_signals"):
+        intermediate_dataframes, peaks, events = builder.process_signals(executor, max_workers, signal_types)
+
+    save_features(intermediate_dataframes, peaks, events, sampling_rate, researcher_initials, participant_id, file_format, profiler, sampling_rates)
 
     print("Data features and events created and saved!")
     
-    return intermediate_dataframes, events
+    return intermediate_dataframes, peaks, events
 
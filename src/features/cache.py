@@ -0,0 +1,92 @@
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+import pandas as pd
+from pathlib import Path
+from read.storage import save_dataframe, load_dataframe
+
+DEFAULT_MAX_BYTES = 5 * 1024 ** 3  # 5 GB
+
+_source_hashes = {}
+
+def source_hash(module_name: str) -> str:
+    '''
+    Hash of the source of a module, so results computed by an older version of it are not reused.
+    '''
+    if module_name not in _source_hashes:
+        source = inspect.getsource(importlib.import_module(module_name))
+        _source_hashes[module_name] = hashlib.sha256(source.encode()).hexdigest()
+    return _source_hashes[module_name]
+
+class ProcessedSignalCache:
+    '''
+    Content-addressed cache of processed signals. An entry is keyed on the hash of the recording
+    file plus everything that changes the processing output (sampling rate, channel, NeuroKit
+    function and version, source of the processing modules, ...), so reruns with only different visualization options skip NeuroKit.
+    The directory is kept under max_bytes by evicting the least recently used entries.
+    '''
+    def __init__(self, cache_dir: Path = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        script_dir = Path(__file__).resolve().parent.parent
+        self.cache_dir = Path(cache_dir) if cache_dir else script_dir.parent / "data" / "cache"
+        self.max_bytes = max_bytes
+        self._file_hashes = {}
+
+    def file_hash(self, data_file: Path) -> str:
+        # Hashing a long recording takes a moment, so it is only done once per file version
+        stat = os.stat(data_file)
+        file_id = (str(Path(data_file).resolve()), stat.st_size, stat.st_mtime_ns)
+        if file_id not in self._file_hashes:
+            digest = hashlib.sha256()
+            with open(data_file, 'rb') as f:
+                for block in iter(lambda: f.read(8 * 1024 ** 2), b''):
+                    digest.update(block)
+            self._file_hashes[file_id] = digest.hexdigest()
+        return self._file_hashes[file_id]
+
+    def key(self, data_file: Path, params: dict) -> str:
+        content = json.dumps({"file": self.file_hash(data_file), **params}, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.parquet"
+
+    def load(self, key: str) -> pd.DataFrame:
+        path = self._path(key)
+        try:
+            df = load_dataframe(path)
+            # Mark the entry as recently used
+            os.utime(path)
+        except (FileNotFoundError, OSError):
+            return None
+        return df
+
+    def save(self, key: str, df: pd.DataFrame):
+        tmp_folder = self.cache_dir / "tmp"
+        tmp_folder.mkdir(parents=True, exist_ok=True)  # other runs may create it at the same time
+        # Write to a temporary file first so a parallel run never reads a half written entry
+        tmp_path = save_dataframe(df, tmp_folder / f"{key}_{os.getpid()}", "parquet")
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.cache_dir.glob("*.parquet"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # evicted by another run
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+                logging.info(f"Evicted {path.name} from the processed signal cache")
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
@@ -0,0 +1,96 @@
+''' Out-of-core processing of very long recordings.
+
+NeuroKit's *_process functions allocate many full-length intermediate arrays, which for overnight
+recordings don't fit in memory. process_chunked splits a channel into windows padded with some
+overlap on both sides, processes them independently (on a worker pool if asked) and keeps only the
+core of every window, so each sample comes from a window that saw enough signal around it. Only a
+bounded number of windows is processed at a time, the output is filled in place.
+'''
+from collections import deque
+import numpy as np
+import pandas as pd
+import neurokit2 as nk
+from read.dtypes import compact_dtype
+from features.peak_index import is_marker
+
+DEFAULT_WINDOW_SECONDS = 600
+DEFAULT_OVERLAP_SECONDS = 30
+# Recordings longer than this are processed in windows by main.py
+AUTO_CHUNK_SECONDS = 3600
+
+def windows(n_samples: int, window_size: int, overlap: int):
+    '''
+    (core start, core end, padded start, padded end) of every window. A last core shorter than the
+    overlap is merged into the previous window.
+    '''
+    starts = list(range(0, n_samples, window_size))
+    if len(starts) > 1 and n_samples - starts[-1] < overlap:
+        starts.pop()
+    ends = starts[1:] + [n_samples]
+    return [(start, end, max(0, start - overlap), min(n_samples, end + overlap)) for start, end in zip(starts, ends)]
+
+def _remove_seam_duplicates(columns: dict, seams: list, tolerance: int):
+    # The same peak can be placed a few samples apart by the windows on either side of a seam,
+    # keep the one before the seam
+    for name, values in columns.items():
+        if not is_marker(name):
+            continue
+        for seam in seams:
+            first = max(0, seam - tolerance)
+            before = np.flatnonzero(values[first:seam]) + first
+            after = np.flatnonzero(values[seam:seam + tolerance]) + seam
+            if len(before) and len(after):
+                values[after[after - before[-1] < tolerance]] = 0
+
+def _refine_eda(columns: dict, sampling_rate: int):
+    # SCR peaks are kept relative to the largest SCR, which differs per window. Detecting them once
+    # on the stitched phasic component matches eda_process, and is cheap next to the decomposition
+    peak_signal, _ = nk.eda_peaks(columns["EDA_Phasic"], sampling_rate=sampling_rate, method="neurokit", amplitude_min=0.1)
+    for name in peak_signal.columns:
+        columns[name] = peak_signal[name].to_numpy().astype(compact_dtype(peak_signal[name]), copy=False)
+
+# Steps that depend on the whole recording and are redone after stitching, per process function
+REFINE = {"eda_process": _refine_eda}
+
+def process_chunked(process_func, signal: pd.Series, sampling_rate: int, window_seconds: float = DEFAULT_WINDOW_SECONDS,
+                    overlap_seconds: float = DEFAULT_OVERLAP_SECONDS, pool=None, max_pending: int = None,
+                    seam_tolerance_seconds: float = 0.2) -> pd.DataFrame:
+    '''
+    process_func (e.g. nk.ecg_process) applied to signal window by window, on pool (a thread or
+    process pool executor) if given. Returns the same processed DataFrame as processing the whole
+    signal at once, up to the edges of the windows.
+    '''
+    from features.build_features import _run_process  # build_features imports this module
+    n_samples = len(signal)
+    window_size = int(window_seconds * sampling_rate)
+    overlap = int(overlap_seconds * sampling_rate)
+    window_bounds = windows(n_samples, window_size, overlap)
+    values = signal.to_numpy()
+    columns = None
+
+    def fill(bounds, processed):
+        nonlocal columns
+        start, end, padded_start, _ = bounds
+        if columns is None:
+            # Allocated once the first window tells the columns, directly in their compact types (see read.dtypes)
+            columns = {name: np.zeros(n_samples, dtype=compact_dtype(processed[name])) for name in processed.columns}
+        for name in processed.columns:
+            columns[name][start:end] = processed[name].to_numpy()[start - padded_start:end - padded_start]
+
+    if pool is None:
+        for bounds in window_bounds:
+            fill(bounds, _run_process(process_func, pd.Series(values[bounds[2]:bounds[3]]), sampling_rate))
+    else:
+        # Keep only a few windows in flight (max_pending, by default two per worker), not the whole recording
+        max_pending = max_pending or 2 * getattr(pool, "_max_workers", 1)
+        pending = deque()
+        for bounds in window_bounds:
+            pending.append((bounds, pool.submit(_run_process, process_func, pd.Series(values[bounds[2]:bounds[3]]), sampling_rate)))
+            while len(pending) >= max_pending or (pending and bounds is window_bounds[-1]):
+                done_bounds, future = pending.popleft()
+                fill(done_bounds, future.result())
+
+    _remove_seam_duplicates(columns, [start for start, *_ in window_bounds[1:]], max(1, int(seam_tolerance_seconds * sampling_rate)))
+    if process_func.__name__ in REFINE and len(window_bounds) > 1:
+        REFINE[process_func.__name__](columns, sampling_rate)
+    return pd.DataFrame(columns, index=signal.index, copy=False)
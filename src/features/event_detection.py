@@ -0,0 +1,160 @@
+''' Automatic detection of the event markers in the slider channel.
+
+During the experiments the start of every stimulus was marked by moving the slider back and forth
+between its extremes (0 and 9). detect_markers finds these bursts of jumps in one vectorized pass,
+align_to_protocol matches them to the events of the study's protocol, and the matched onsets replace
+the protocol's nominal onsets in the events structure. The proposal can be checked without running
+the pipeline:
+
+    cd src && python -m features.event_detection path/to/recording.mat 2000 --protocol 6_BAK_pilot_tobii_biopac
+'''
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+def detect_markers(slider, sampling_rate: int, low: float = 0, high: float = 9, tolerance: float = 0.5,
+                   max_jump_seconds: float = 0.2, max_gap_seconds: float = 1.0, min_jumps: int = 3):
+    '''
+    Find the bursts of jumps between low and high in the slider signal.
+    A jump is a switch between a sample within tolerance of one extreme and the next sample near the
+    other extreme, at most max_jump_seconds later. Jumps less than max_gap_seconds apart belong to the
+    same burst, and bursts of at least min_jumps jumps are markers.
+    Returns (starts, ends) of the markers in samples.
+    '''
+    slider = np.asarray(slider, dtype=float)
+    # -1 near the low extreme, +1 near the high one, 0 in between (a normal rating)
+    level = np.where(slider <= low + tolerance, -1, 0) + np.where(slider >= high - tolerance, 1, 0)
+    extremes = np.flatnonzero(level)
+    extreme_levels = level[extremes]
+
+    changes = extreme_levels[1:] != extreme_levels[:-1]
+    switches = changes & (np.diff(extremes) <= max_jump_seconds * sampling_rate)
+    # First sample of the run of the same extreme each sample belongs to
+    run_starts = np.concatenate([[True], changes | (np.diff(extremes) > 1)])
+    first_of_run = extremes[np.maximum.accumulate(np.where(run_starts, np.arange(len(extremes)), 0))]
+    jumps_from = first_of_run[:-1][switches]
+    jumps = extremes[1:][switches]
+    if len(jumps) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    # A new burst starts wherever the gap to the previous jump is too long
+    new_burst = np.diff(jumps) > max_gap_seconds * sampling_rate
+    burst_starts = np.concatenate([[0], np.flatnonzero(new_burst) + 1])
+    burst_ends = np.concatenate([burst_starts[1:], [len(jumps)]]) - 1
+    n_jumps = burst_ends - burst_starts + 1
+    markers = n_jumps >= min_jumps
+    # The marker starts where the slider reached the extreme the first jump leaves from, at most a gap earlier
+    starts = np.maximum(jumps_from[burst_starts[markers]], jumps[burst_starts[markers]] - int(max_gap_seconds * sampling_rate))
+    return starts, jumps[burst_ends[markers]]
+
+def _assign_in_order(markers, positions, tolerance):
+    # One-to-one matching of the sorted positions to the sorted markers that keeps their order: the most
+    # pairs within tolerance, then the smallest total distance (dynamic programming over both lists)
+    n_positions, n_markers = len(positions), len(markers)
+    # best[i, j]: (number of pairs, -total distance) matching the first i positions to the first j markers
+    best = np.zeros((n_positions + 1, n_markers + 1, 2))
+    for i in range(1, n_positions + 1):
+        for j in range(1, n_markers + 1):
+            options = [tuple(best[i - 1, j]), tuple(best[i, j - 1])]
+            distance = abs(positions[i - 1] - markers[j - 1])
+            if distance <= tolerance:
+                options.append((best[i - 1, j - 1, 0] + 1, best[i - 1, j - 1, 1] - distance))
+            best[i, j] = max(options)
+    assigned = np.full(n_positions, -1)
+    i, j = n_positions, n_markers
+    while i > 0 and j > 0:
+        if tuple(best[i, j]) == tuple(best[i - 1, j]):
+            i -= 1
+        elif tuple(best[i, j]) == tuple(best[i, j - 1]):
+            j -= 1
+        else:
+            assigned[i - 1] = j - 1
+            i, j = i - 1, j - 1
+    return assigned
+
+def align_to_protocol(markers, expected_onsets, sampling_rate: int, tolerance_seconds: float = 30):
+    '''
+    Match the detected markers to the protocol's expected onsets (both in samples). The recording
+    may start earlier or later than the protocol assumes, so the shift that matches the most
+    events is found first, then the events are matched one-to-one to the markers in order, each
+    within the tolerance of its shifted onset. The tolerance is tolerance_seconds, but always less
+    than half the shortest gap between events, so a missed marker can't take its neighbour's.
+    Returns (onsets, detected): the proposed onset of every event, and whether it was detected
+    or only shifted from the protocol.
+    '''
+    markers = np.sort(np.asarray(markers))
+    expected_onsets = np.asarray(expected_onsets)
+    if len(markers) == 0:
+        return expected_onsets.copy(), np.zeros(len(expected_onsets), dtype=bool)
+    tolerance = tolerance_seconds * sampling_rate
+    if len(expected_onsets) > 1:
+        tolerance = min(tolerance, (np.diff(expected_onsets).min() - 1) / 2)
+
+    def nearest(positions):
+        # Distance from every position to its nearest marker
+        right = np.clip(np.searchsorted(markers, positions), 0, len(markers) - 1)
+        left = np.clip(right - 1, 0, len(markers) - 1)
+        return np.minimum(np.abs(positions - markers[left]), np.abs(positions - markers[right]))
+
+    # Every (marker, event) pair proposes a shift, score all of them at once
+    shifts = np.unique((markers[:, None] - expected_onsets[None, :]).ravel())
+    distances = nearest(expected_onsets[None, :] + shifts[:, None])
+    within = distances <= tolerance
+    n_matched = within.sum(axis=1)
+    total_distance = np.where(within, distances, 0).sum(axis=1)
+    best = np.lexsort((total_distance, -n_matched))[0]
+    shift = shifts[best] if n_matched[best] else 0
+
+    assigned = _assign_in_order(markers, expected_onsets + shift, tolerance)
+    detected = assigned >= 0
+    onsets = np.where(detected, markers[assigned], expected_onsets + shift)
+    # Matched markers keep the events' order and are within less than half a gap of them, so the onsets increase
+    if not np.all(np.diff(onsets) > 0):
+        raise ValueError("The aligned event onsets are not increasing")
+    return onsets, detected
+
+def detect_events(slider, sampling_rate: int, protocol, **kwargs) -> dict:
+    '''
+    The protocol's events (see Protocol.events) with the onsets taken from the slider markers.
+    "detected" marks the events whose onset was found in the slider, the others keep the
+    protocol's onset (shifted like the detected ones, and not analyzed if that moves it outside
+    the recording).
+    '''
+    nominal = protocol.events(sampling_rate, len(slider))
+    starts, _ = detect_markers(slider, sampling_rate, **kwargs)
+    onsets, detected = align_to_protocol(starts, nominal["onset"], sampling_rate)
+    print(f"Detected {detected.sum()} of {len(detected)} event markers in the slider")
+    events = protocol.events(sampling_rate, len(slider), onsets=onsets)
+    events["detected"] = detected
+    inside = (onsets >= 0) & (onsets < len(slider))
+    if not np.all(events["duration"][inside] > 0):
+        raise ValueError("Some events inside the recording have empty epochs after the alignment")
+    return events
+
+def events_table(events: dict, sampling_rate: int) -> pd.DataFrame:
+    # Readable summary of the events, saved next to the interim files for review
+    return pd.DataFrame({
+        "label": events["label"],
+        "onset_s": np.asarray(events["onset"]) / sampling_rate,
+        "offset_s": np.asarray(events["offset"]) / sampling_rate,
+        "analyze": events.get("analyze"),
+        "detected": events.get("detected"),
+    })
+
+if __name__ == '__main__':
+    from read.make_dataset import DataPreparation
+    from features.build_features import COLUMN_LABELS
+    from features.protocol import load_protocol, DEFAULT_PROTOCOL
+
+    parser = argparse.ArgumentParser(description="Propose the event onsets of a recording from its slider markers.")
+    parser.add_argument("data_file", type=Path)
+    parser.add_argument("sampling_rate", type=int, nargs="?")
+    parser.add_argument("--protocol", default=DEFAULT_PROTOCOL)
+    args = parser.parse_args()
+
+    data_prep = DataPreparation(args.data_file, args.sampling_rate, [COLUMN_LABELS['slider']])
+    data, labels, units = data_prep.load_data()
+    slider = data_prep.create_dataframe(data, labels, units)[COLUMN_LABELS['slider']]
+    events = detect_events(slider.to_numpy(), data_prep.sampling_rate, load_protocol(args.protocol))
+    print(events_table(events, data_prep.sampling_rate).to_string(index=False))
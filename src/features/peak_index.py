@@ -0,0 +1,56 @@
+''' Sparse index of the NeuroKit marker columns.
+
+NeuroKit marks peaks, onsets, ... with full-length 0/1 columns (ECG_R_Peaks, SCR_Peaks, ...),
+although the analyses only need their positions. split_markers replaces them with one sorted
+sample index array per marker, so a modality is its continuous columns plus a
+{marker name: indices} dict. The indices are saved next to the interim files as .npz, and
+dense columns are only rebuilt for the rows that need them (an epoch, a NeuroKit plot).
+'''
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from read.dtypes import MARKER_DTYPE
+
+# Columns that mark events (peaks, onsets, ...) with 1 at their sample
+MARKER_SUFFIXES = ("_Peaks", "_Onsets", "_Offsets", "_Troughs", "_Recovery")
+
+def is_marker(name: str) -> bool:
+    return name.endswith(MARKER_SUFFIXES)
+
+def split_markers(processed_df: pd.DataFrame):
+    '''
+    (continuous columns, {marker name: sorted sample indices}) of a processed DataFrame.
+    '''
+    markers = [name for name in processed_df.columns if is_marker(name)]
+    peaks = {name: np.flatnonzero(processed_df[name].to_numpy()) for name in markers}
+    return processed_df.drop(columns=markers), peaks
+
+def marker_columns(peaks: dict, start: int, stop: int) -> dict:
+    '''
+    Dense 0/1 columns of the markers between start and stop, found by binary search so the cost
+    is the number of markers in the range, not of the whole recording.
+    '''
+    columns = {}
+    for name, indices in peaks.items():
+        column = np.zeros(stop - start, dtype=MARKER_DTYPE)
+        column[indices[np.searchsorted(indices, start):np.searchsorted(indices, stop)] - start] = 1
+        columns[name] = column
+    return columns
+
+def with_markers(signal: pd.DataFrame, peaks: dict, start: int = 0) -> pd.DataFrame:
+    '''
+    signal (rows start to start + len(signal) of a modality) with its dense marker columns, as NeuroKit expects.
+    '''
+    if not peaks:
+        return signal
+    markers = pd.DataFrame(marker_columns(peaks, start, start + len(signal)), index=signal.index)
+    return pd.concat([signal, markers], axis=1)
+
+def save_peaks(peaks: dict, path: Path) -> Path:
+    path = Path(path).with_suffix(".npz")
+    np.savez_compressed(path, **peaks)
+    return path
+
+def load_peaks(path: Path) -> dict:
+    with np.load(path) as saved:
+        return {name: saved[name] for name in saved.files}
@@ -0,0 +1,146 @@
+''' Experiment protocols: the events of a study and which of them are analyzed.
+
+A protocol is a JSON (or YAML, if PyYAML is installed) file in features/protocols, or anywhere else:
+
+    {
+        "name": "6_BAK_pilot_tobii_biopac",
+        "exclude": ["pci"],
+        "events": [{"label": "1stSilence", "onset": 56.2}, {"label": "1stPCI", "onset": 356.2}, ...]
+    }
+
+Onsets (and optional offsets) are in seconds. An event lasts until its offset, or else the next
+onset (the end of the recording for the last one), events starting outside the recording are empty
+and not analyzed. include/exclude are case-insensitive regular expressions matched against
+the labels: only events matching an include pattern (all of them if there is none) and no exclude
+pattern are cut into epochs for the analyses.
+'''
+import json
+import re
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+from features.peak_index import with_markers
+from features.resample import modality_rate, resample_events
+
+PROTOCOLS_FOLDER = Path(__file__).resolve().parent / "protocols"
+DEFAULT_PROTOCOL = "6_BAK_pilot_tobii_biopac"
+
+class Protocol:
+    def __init__(self, name: str, labels: list, onsets: list, offsets: list = None, include: list = None, exclude: list = None):
+        self.name = name
+        # Labels are numbered so repeated conditions stay apart, e.g. "1stSilence_1"
+        self.labels = [f"{label}_{i+1}" for i, label in enumerate(labels)]
+        self.onsets = np.asarray(onsets, dtype=float)
+        self.offsets = np.asarray([np.nan if offset is None else offset for offset in offsets], dtype=float) \
+            if offsets is not None else np.full(len(self.onsets), np.nan)
+        self.include = include or []
+        self.exclude = exclude or []
+
+    @classmethod
+    def from_dict(cls, protocol: dict):
+        events = protocol["events"]
+        return cls(protocol["name"],
+                   [event["label"] for event in events],
+                   [event["onset"] for event in events],
+                   [event.get("offset") for event in events],
+                   protocol.get("include"),
+                   protocol.get("exclude"))
+
+    def analyzed(self) -> np.ndarray:
+        '''
+        Boolean mask of the events that pass the include/exclude rules.
+        '''
+        def matches(patterns):
+            return np.array([any(re.search(pattern, label, re.IGNORECASE) for pattern in patterns) for label in self.labels], dtype=bool)
+
+        mask = matches(self.include) if self.include else np.ones(len(self.labels), dtype=bool)
+        if self.exclude:
+            mask &= ~matches(self.exclude)
+        return mask
+
+    def events(self, sampling_rate: int, n_samples: int, onsets: np.ndarray = None) -> dict:
+        '''
+        The events in samples, like nk.events_create, plus the precomputed offset of every event
+        and the "analyze" mask of the include/exclude rules. onsets (in samples) replace the
+        protocol's, e.g. when they were detected in the recording; fixed offsets move with them.
+        '''
+        nominal_onsets = (self.onsets * sampling_rate).astype(int)
+        onsets = nominal_onsets if onsets is None else np.asarray(onsets, dtype=int)
+        next_onsets = np.append(onsets[1:], n_samples)
+        fixed_offsets = onsets + (self.offsets * sampling_rate - nominal_onsets)
+        offsets = np.where(np.isnan(self.offsets), next_onsets, fixed_offsets).astype(int)
+        # Events starting before or after the recording (e.g. a recording stopped early, or onsets shifted before
+        # its start) are kept, so they stay aligned with the protocol, but are clamped into it, empty
+        # (offset = onset) and never analyzed
+        outside = (onsets < 0) | (onsets >= n_samples)
+        if outside.any():
+            print(f"Warning: The recording (0 to {n_samples / sampling_rate:.1f} s) does not cover the onset of "
+                  f"{', '.join(np.asarray(self.labels)[outside])}. These events are not analyzed")
+        onsets = np.clip(onsets, 0, max(n_samples - 1, 0))
+        offsets = np.where(outside, onsets, np.maximum(np.minimum(offsets, n_samples), onsets))
+        return {
+            "onset": onsets,
+            "offset": offsets,
+            "duration": offsets - onsets,
+            "label": self.labels,
+            "analyze": self.analyzed() & ~outside & (offsets > onsets),
+            "protocol": self.name,
+        }
+
+@lru_cache(maxsize=None)
+def load_protocol(protocol: str = DEFAULT_PROTOCOL) -> Protocol:
+    '''
+    Load a protocol by name (a file in features/protocols) or by path. Each file is only read once.
+    '''
+    path = Path(protocol)
+    if not path.suffix:
+        candidates = [PROTOCOLS_FOLDER / f"{protocol}{suffix}" for suffix in (".json", ".yaml", ".yml")]
+        path = next((candidate for candidate in candidates if candidate.exists()), candidates[0])
+    if not path.exists():
+        available = sorted(p.stem for p in PROTOCOLS_FOLDER.glob("*.*"))
+        raise FileNotFoundError(f"Protocol {protocol} not found, available protocols: {available}")
+
+    with open(path) as f:
+        if path.suffix in (".yaml", ".yml"):
+            import yaml  # only needed for YAML protocols
+            return Protocol.from_dict(yaml.safe_load(f))
+        return Protocol.from_dict(json.load(f))
+
+def epoch_bounds(events: dict, n_samples: int = None):
+    '''
+    (labels, onsets, offsets) of the analyzed, non-empty epochs. Computed once and used to cut
+    every modality, which all share the same sample index.
+    '''
+    onsets = np.asarray(events["onset"])
+    offsets = np.asarray(events["offset"]) if "offset" in events else np.append(onsets[1:], n_samples)
+    if n_samples is not None:
+        offsets = np.minimum(offsets, n_samples)
+    keep = np.array(events.get("analyze", np.ones(len(onsets))), dtype=bool)
+    empty = keep & (offsets <= onsets)
+    for label in np.asarray(events["label"])[empty]:
+        print(f"Warning: Empty epoch for label {label}")
+    keep &= ~empty
+    return [label for label, k in zip(events["label"], keep) if k], onsets[keep], offsets[keep]
+
+def cut_epochs(signals: dict, events: dict, peaks: dict = None, sampling_rate: int = None, sampling_rates: dict = None) -> dict:
+    '''
+    Cut every signal in signals ({signal_type: DataFrame}) into its epochs in one pass over the
+    precomputed bounds. Returns {signal_type: [(label, epoch), ...]}, the epochs are views, not copies,
+    unless peaks ({signal_type: {marker name: indices}}) are given: then each epoch gets the dense
+    marker columns of its own peaks. Signals resampled to their own rate (sampling_rates, see
+    features.resample) are cut with the events rescaled from sampling_rate, once per rate.
+    '''
+    signals = {signal_type: signal for signal_type, signal in signals.items() if signal is not None}
+    if not signals:
+        return {}
+    rates = {signal_type: modality_rate(sampling_rate, sampling_rates, signal_type) if sampling_rates else sampling_rate
+             for signal_type in signals}
+    bounds = {}
+    for rate in set(rates.values()):
+        n_samples = min(len(signal) for signal_type, signal in signals.items() if rates[signal_type] == rate)
+        rate_events = resample_events(events, sampling_rate, rate, n_samples) if rate != sampling_rate else events
+        bounds[rate] = epoch_bounds(rate_events, n_samples)
+    peaks = peaks or {}
+    return {signal_type: [(label, with_markers(signal.iloc[onset:offset], peaks.get(signal_type), onset))
+                          for label, onset, offset in zip(*bounds[rates[signal_type]])]
+            for signal_type, signal in signals.items()}
@@ -0,0 +1,56 @@
+''' Per-modality resampling before the NeuroKit processing.
+
+All channels are recorded at the acquisition rate (often 2 kHz), although EDA, respiration and the
+slider carry nothing above a few Hz. Each modality can be given its own target rate in a
+sampling_rates dict ({modality: Hz}): its channel is then decimated with an anti-aliasing polyphase
+filter before NeuroKit runs, so the processing time and memory of the slow modalities shrink with
+the rate. Events stay in samples at the acquisition rate and are rescaled to a modality's rate
+where they are used with it (epochs, HRV).
+'''
+from fractions import Fraction
+import numpy as np
+from scipy.signal import resample_poly
+from read.dtypes import SIGNAL_DTYPE
+
+# ECG and PPG keep the acquisition rate by default, for the timing of the R-peaks
+DEFAULT_SAMPLING_RATES = {"eda": 100, "rsp": 100, "slider": 100}
+
+def modality_rate(sampling_rate: int, sampling_rates: dict, signal_type: str) -> int:
+    '''
+    The rate signal_type is processed at: its target in sampling_rates, but never above the acquisition rate.
+    '''
+    target_rate = (sampling_rates or {}).get(signal_type)
+    if not target_rate or target_rate >= sampling_rate:
+        return sampling_rate
+    return target_rate
+
+def resample(values, sampling_rate: int, target_rate: int) -> np.ndarray:
+    '''
+    values at target_rate, low-pass filtered below the new Nyquist frequency by resample_poly.
+    '''
+    values = np.asarray(values)
+    if target_rate == sampling_rate:
+        return values
+    # The exact ratio of the rates, an approximated one gives signals of slightly the wrong length
+    ratio = Fraction(int(target_rate), int(sampling_rate))
+    # padtype="line" avoids the ringing of zero padding at the edges of signals with an offset (EDA levels, RSP baseline)
+    resampled = resample_poly(values, ratio.numerator, ratio.denominator, padtype="line")
+    return resampled.astype(SIGNAL_DTYPE, copy=False)
+
+def resample_events(events: dict, sampling_rate: int, target_rate: int, n_samples: int = None) -> dict:
+    '''
+    events (onsets and offsets in samples at sampling_rate) in samples at target_rate.
+    '''
+    if target_rate == sampling_rate:
+        return events
+    scale = target_rate / sampling_rate
+    onsets = np.round(np.asarray(events["onset"]) * scale).astype(int)
+    resampled = dict(events, onset=onsets)
+    if "offset" in events:
+        offsets = np.round(np.asarray(events["offset"]) * scale).astype(int)
+        if n_samples is not None:
+            offsets = np.maximum(np.minimum(offsets, n_samples), onsets)
+        resampled.update(offset=offsets, duration=offsets - onsets)
+    elif "duration" in events:
+        resampled["duration"] = np.round(np.asarray(events["duration"]) * scale).astype(int)
+    return resampled
@@ -0,0 +1,191 @@
+''' Streaming (online) processing of BIOPAC signals for biofeedback sessions.
+
+StreamingFeatureBuilder consumes fixed-size blocks of samples and emits heart rate, breathing rate
+and EDA tonic/phasic levels after every block. It uses the same NeuroKit cleaning and peak detection
+as FeatureBuilder, rerun after every block on a rolling buffer of the last seconds of each signal
+(NeuroKit's filters are zero-phase, they need the signal on both sides). It differs from the offline
+processing in that the modalities are processed at the acquisition rate, peaks and EDA levels are
+only final (and reported) a fixed time after they occur, and the rates are the median of the last intervals rather than
+interpolated between the peaks. Sources yield the blocks; FileReplaySource replays a recorded
+.mat/.acq file at real-time or accelerated speed for testing:
+
+    cd src && python -m features.streaming path/to/recording.mat 2000 --speed 10
+'''
+import argparse
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import neurokit2 as nk
+from read.make_dataset import DataPreparation
+from features.build_features import COLUMN_LABELS
+
+class SampleSource(ABC):
+    '''
+    Interface of a live sample source: blocks() yields DataFrames of block_size rows with
+    the "label (unit)" channel columns, as soon as they are acquired.
+    '''
+    def __init__(self, sampling_rate: int, block_size: int):
+        self.sampling_rate = sampling_rate
+        self.block_size = block_size
+
+    @abstractmethod
+    def blocks(self):
+        '''
+        Yield the blocks of samples as they are acquired.
+        '''
+
+class FileReplaySource(SampleSource):
+    '''
+    Replays a recorded file in blocks of block_seconds. speed=1 is real time, speed=10 ten times
+    faster and speed=None as fast as possible.
+    '''
+    def __init__(self, data_file: Path, sampling_rate: int, block_seconds: float, speed: float = 1.0, channels: list = None):
+        data_prep = DataPreparation(data_file, sampling_rate, channels if channels is not None else list(COLUMN_LABELS.values()))
+        data, labels, units = data_prep.load_data()
+        if data is None:
+            raise IOError(f"Could not load {data_file}")
+        # The block size comes from the rate of the file, .acq files carry their own
+        super().__init__(data_prep.sampling_rate, max(1, int(block_seconds * data_prep.sampling_rate)))
+        self.data_file = data_file
+        self.speed = speed
+        self.df = data_prep.create_dataframe(data, labels, units)
+
+    def blocks(self):
+        df = self.df
+        block_duration = self.block_size / self.sampling_rate
+        start = time.perf_counter()
+        for i, begin in enumerate(range(0, len(df), self.block_size)):
+            if self.speed:
+                # A block is only available once all of its samples have been "acquired"
+                wait = start + (i + 1) * block_duration / self.speed - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            yield df.iloc[begin:begin + self.block_size]
+
+class _RollingSignal:
+    '''
+    The last buffer_seconds of a raw signal, rerun through NeuroKit's cleaning (clean(signal,
+    sampling_rate=...), as in FeatureBuilder's processing) after every block once min_seconds of it
+    were acquired. update() returns the cleaned buffer, or None while it is too short. Its filters
+    are zero-phase, so the end of the buffer changes with every block: only the samples followed by
+    confirm_seconds of signal are final, which bounds the latency.
+    '''
+    def __init__(self, clean, sampling_rate, buffer_seconds, min_seconds, confirm_seconds):
+        self.clean = clean
+        self.sampling_rate = sampling_rate
+        self.buffer_size = int(buffer_seconds * sampling_rate)
+        self.confirm = int(confirm_seconds * sampling_rate)
+        self.min_size = max(int(min_seconds * sampling_rate), self.confirm + 1)
+        self.buffer = np.empty(0)
+        self.n_samples = 0  # samples seen so far, to turn buffer positions into recording indices
+
+    def update(self, block):
+        self.buffer = np.concatenate([self.buffer, block])[-self.buffer_size:]
+        self.n_samples += len(block)
+        if len(self.buffer) < self.min_size:
+            return None
+        return self.clean(self.buffer, sampling_rate=self.sampling_rate)
+
+class _RollingPeaks(_RollingSignal):
+    '''
+    NeuroKit's peak detection (find_peaks(cleaned, sampling_rate) returns the peak indices) on the
+    cleaned buffer. A peak is only confirmed once confirm_seconds of signal follow it.
+    '''
+    def __init__(self, clean, find_peaks, sampling_rate, buffer_seconds, min_seconds, confirm_seconds, min_distance_seconds, n_intervals=8):
+        super().__init__(clean, sampling_rate, buffer_seconds, min_seconds, confirm_seconds)
+        self.find_peaks = find_peaks
+        # The same peak found again in the next buffers may move by a few samples
+        self.min_distance = max(1, int(min_distance_seconds * sampling_rate))
+        self.peaks = deque(maxlen=n_intervals + 1)
+
+    def update(self, block):
+        cleaned = super().update(block)
+        if cleaned is None:
+            return
+        peaks = np.asarray(self.find_peaks(cleaned, self.sampling_rate), dtype=np.int64)
+
+        buffer_start = self.n_samples - len(cleaned)
+        last_peak = self.peaks[-1] if self.peaks else -self.min_distance
+        for peak in peaks[peaks < len(cleaned) - self.confirm] + buffer_start:
+            if peak >= last_peak + self.min_distance:
+                self.peaks.append(peak)
+                last_peak = peak
+
+    def rate(self):
+        # Per minute, from the median of the last intervals so a missed or extra peak doesn't swing it
+        if len(self.peaks) < 2:
+            return np.nan
+        return 60 * self.sampling_rate / np.median(np.diff(self.peaks))
+
+def _ecg_peaks(cleaned, sampling_rate):
+    return nk.ecg_peaks(cleaned, sampling_rate=sampling_rate)[1]["ECG_R_Peaks"]
+
+def _rsp_peaks(cleaned, sampling_rate):
+    return nk.rsp_peaks(cleaned, sampling_rate=sampling_rate)[1]["RSP_Peaks"]
+
+class StreamingFeatureBuilder:
+    '''
+    Online counterpart of FeatureBuilder for live sessions: process() takes one block of samples
+    (with the channels of column_labels) and returns the current rates and EDA levels, named like
+    the columns of NeuroKit's processing.
+    '''
+    def __init__(self, sampling_rate: int, column_labels: dict = None):
+        self.sampling_rate = sampling_rate
+        self.column_labels = column_labels or COLUMN_LABELS
+        self.n_samples = 0
+
+        # The default methods of nk.ecg_process, nk.rsp_process and nk.eda_process
+        self.ecg = _RollingPeaks(nk.ecg_clean, _ecg_peaks, sampling_rate, buffer_seconds=10, min_seconds=2,
+                                 confirm_seconds=0.5, min_distance_seconds=0.3)
+        self.rsp = _RollingPeaks(nk.rsp_clean, _rsp_peaks, sampling_rate, buffer_seconds=30, min_seconds=10,
+                                 confirm_seconds=2.0, min_distance_seconds=1.5)
+        self.eda = _RollingSignal(nk.eda_clean, sampling_rate, buffer_seconds=60, min_seconds=5, confirm_seconds=2.0)
+
+    def process(self, block: pd.DataFrame) -> dict:
+        start = time.perf_counter()
+        self.n_samples += len(block)
+
+        self.ecg.update(block[self.column_labels['ecg']].to_numpy(dtype=float))
+        self.rsp.update(block[self.column_labels['rsp']].to_numpy(dtype=float))
+        eda = self.eda.update(block[self.column_labels['eda']].to_numpy(dtype=float))
+        tonic = phasic = np.nan
+        if eda is not None:
+            # Levels at the last confirmed sample, like the peaks, away from the edge effects at the end of the buffer
+            tonic, phasic = nk.eda_phasic(eda, sampling_rate=self.sampling_rate)[["EDA_Tonic", "EDA_Phasic"]].iloc[-self.eda.confirm - 1]
+
+        return {
+            "Time": self.n_samples / self.sampling_rate,
+            "ECG_Rate": self.ecg.rate(),
+            "RSP_Rate": self.rsp.rate(),
+            "EDA_Tonic": tonic,
+            "EDA_Phasic": phasic,
+            "Processing_Time": time.perf_counter() - start,
+        }
+
+    def run(self, source: SampleSource):
+        '''
+        Process every block of source as it arrives, yielding the features after each one.
+        '''
+        for block in source.blocks():
+            yield self.process(block)
+
+def main(data_file: Path, sampling_rate: int, block_seconds: float = 0.25, speed: float = 1.0):
+    print("Streaming recording...")
+    source = FileReplaySource(data_file, sampling_rate, block_seconds, speed)
+    builder = StreamingFeatureBuilder(source.sampling_rate)
+    for features in builder.run(source):
+        print(f"{features['Time']:8.2f} s  HR {features['ECG_Rate']:6.1f}  BR {features['RSP_Rate']:5.1f}  "
+              f"SCL {features['EDA_Tonic']:6.3f}  SCR {features['EDA_Phasic']:+.3f}  ({features['Processing_Time'] * 1000:.1f} ms)")
+    print("Streaming complete!")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a recording through the streaming engine.")
+    parser.add_argument("data_file", type=Path)
+    parser.add_argument("sampling_rate", type=int, nargs="?", help="Sampling rate of a .mat recording (.acq files use their own)")
+    parser.add_argument("--block-seconds", type=float, default=0.25)
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 0 for as fast as possible")
+    args = parser.parse_args()
+    main(args.data_file, args.sampling_rate, args.block_seconds, args.speed)
@@ -0,0 +1,170 @@
+''' Sliding-window feature time series.
+
+The interval features of the Excel table are computed once per event by NeuroKit's
+*_intervalrelated functions, which is far too slow for thousands of overlapping windows. Here the
+windows are evaluated all at once: the means and SDs of continuous columns come from prefix sums
+of the column, and the features of the intervals between peaks (R-peaks, breaths, SCRs) from prefix
+sums over the intervals, with the peaks inside each window found by binary search on the sparse peak
+indices. The cost is O(samples + peaks + windows) whatever the window and step sizes.
+
+The result is one row per window (its start in seconds) and one float32 column per feature, named
+like NeuroKit's interval-related features:
+
+    cd src && python -m features.windowed TT LO1234 --window 60 --step 5
+'''
+import argparse
+import json
+import numpy as np
+import pandas as pd
+from read.dtypes import SIGNAL_DTYPE
+from read.storage import save_dataframe, DEFAULT_FORMAT
+from features.resample import modality_rate
+
+FEATURE_WINDOW_SECONDS = 60
+FEATURE_STEP_SECONDS = 5
+# Modalities with windowed features
+WINDOWED_MODALITIES = ["ecg", "rsp", "eda"]
+
+def window_starts(duration_seconds: float, window_seconds: float, step_seconds: float) -> np.ndarray:
+    '''
+    Start (in seconds) of every window of window_seconds that fits in the recording, every step_seconds.
+    '''
+    if duration_seconds < window_seconds:
+        return np.empty(0)
+    n_windows = int(np.floor((duration_seconds - window_seconds) / step_seconds + 1e-9)) + 1
+    return np.arange(n_windows) * step_seconds
+
+def _prefix_sums(values: np.ndarray) -> np.ndarray:
+    # prefix[i] is the sum of the first i values, so the sum of values[a:b] is prefix[b] - prefix[a]
+    prefix = np.zeros(len(values) + 1)
+    np.cumsum(values, out=prefix[1:])
+    return prefix
+
+def window_mean_sd(values, first: np.ndarray, stop: np.ndarray) -> tuple:
+    '''
+    Mean and SD (ddof=1, as NeuroKit) of values[first:stop] for every window, ignoring NaNs.
+    '''
+    values = np.asarray(values, dtype=float)
+    valid = np.isfinite(values)
+    # Centred first, so the sums of squares don't lose the small variances of slow signals (EDA levels)
+    centre = values[valid].mean() if valid.any() else 0.0
+    centred = np.where(valid, values - centre, 0.0)
+    first, stop = np.minimum(first, len(values)), np.minimum(stop, len(values))
+
+    prefix_count, prefix, prefix_squares = _prefix_sums(valid), _prefix_sums(centred), _prefix_sums(centred ** 2)
+    count = prefix_count[stop] - prefix_count[first]
+    total, total_squares = prefix[stop] - prefix[first], prefix_squares[stop] - prefix_squares[first]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+        variance = (total_squares - total * mean) / (count - 1)
+    sd = np.sqrt(np.clip(variance, 0, None))
+    return np.where(count > 0, mean + centre, np.nan), np.where(count > 1, sd, np.nan)
+
+def interval_features(peaks, sampling_rate: int, first: np.ndarray, stop: np.ndarray) -> dict:
+    '''
+    Mean and SD of the intervals (in ms) between the peaks in [first, stop) of every window, and the
+    RMSSD of their successive differences, as NeuroKit computes them on the peaks of an epoch.
+    '''
+    peaks = np.asarray(peaks, dtype=np.int64)
+    intervals = np.diff(peaks) / sampling_rate * 1000  # interval k is between peaks k and k + 1
+    # Peaks first_peak to stop_peak - 1 are in the window, the intervals first_peak to stop_peak - 2 are between them
+    first_peak, stop_peak = np.searchsorted(peaks, first), np.searchsorted(peaks, stop)
+    first_interval = np.minimum(first_peak, len(intervals))
+    mean, sd = window_mean_sd(intervals, first_interval, np.maximum(stop_peak - 1, first_interval))
+
+    differences = np.diff(intervals)  # difference k is between intervals k and k + 1, so peaks k to k + 2
+    first_difference = np.minimum(first_peak, len(differences))
+    stop_difference = np.maximum(np.minimum(stop_peak - 2, len(differences)), first_difference)
+    squares = _prefix_sums(differences ** 2)
+    count = stop_difference - first_difference
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rmssd = np.sqrt((squares[stop_difference] - squares[first_difference]) / count)
+    return {"mean": mean, "sd": sd, "rmssd": np.where(count > 0, rmssd, np.nan)}
+
+def _ecg_features(signal: pd.DataFrame, peaks: dict, sampling_rate: int, first: np.ndarray, stop: np.ndarray) -> dict:
+    intervals = interval_features(peaks["ECG_R_Peaks"], sampling_rate, first, stop)
+    return {
+        "ECG_Rate_Mean": window_mean_sd(signal["ECG_Rate"], first, stop)[0],
+        "HRV_MeanNN": intervals["mean"],
+        "HRV_SDNN": intervals["sd"],
+        "HRV_RMSSD": intervals["rmssd"],
+    }
+
+def _rsp_features(signal: pd.DataFrame, peaks: dict, sampling_rate: int, first: np.ndarray, stop: np.ndarray) -> dict:
+    # Breath-to-breath intervals between the troughs (inhalation onsets), as NeuroKit's rsp_rrv
+    breaths = interval_features(peaks["RSP_Troughs"], sampling_rate, first, stop)
+    return {
+        "RSP_Rate_Mean": window_mean_sd(signal["RSP_Rate"], first, stop)[0],
+        "RSP_Amplitude_Mean": window_mean_sd(signal["RSP_Amplitude"], first, stop)[0],
+        "RRV_MeanBB": breaths["mean"],
+        "RRV_SDBB": breaths["sd"],
+        "RRV_RMSSD": breaths["rmssd"],
+    }
+
+def _eda_features(signal: pd.DataFrame, peaks: dict, sampling_rate: int, first: np.ndarray, stop: np.ndarray) -> dict:
+    scr_peaks = np.asarray(peaks["SCR_Peaks"], dtype=np.int64)
+    first_peak, stop_peak = np.searchsorted(scr_peaks, first), np.searchsorted(scr_peaks, stop)
+    amplitudes = signal["SCR_Amplitude"].to_numpy()[scr_peaks]
+    tonic_mean, tonic_sd = window_mean_sd(signal["EDA_Tonic"], first, stop)
+    return {
+        "SCR_Peaks_N": (stop_peak - first_peak).astype(float),
+        "SCR_Peaks_Amplitude_Mean": window_mean_sd(amplitudes, first_peak, stop_peak)[0],
+        "EDA_Tonic_Mean": tonic_mean,
+        "EDA_Tonic_SD": tonic_sd,
+    }
+
+WINDOW_FEATURES = {"ecg": _ecg_features, "rsp": _rsp_features, "eda": _eda_features}
+
+def windowed_features(processed_dataframes: dict, peaks: dict, sampling_rate: int, sampling_rates: dict = None,
+                      window_seconds: float = FEATURE_WINDOW_SECONDS, step_seconds: float = FEATURE_STEP_SECONDS) -> pd.DataFrame:
+    '''
+    The features of every window of window_seconds, every step_seconds, from the processed signals
+    (without their marker columns) and peak indices of the modalities. The windows are in seconds,
+    so the modalities resampled to other rates (sampling_rates) share them.
+    '''
+    modalities = [signal_type for signal_type in WINDOWED_MODALITIES if processed_dataframes.get(signal_type) is not None]
+    rates = {signal_type: modality_rate(sampling_rate, sampling_rates, signal_type) for signal_type in modalities}
+    duration = min((len(processed_dataframes[signal_type]) / rates[signal_type] for signal_type in modalities), default=0)
+    starts = window_starts(duration, window_seconds, step_seconds)
+
+    table = {"window_start_s": starts}
+    for signal_type in modalities:
+        rate = rates[signal_type]
+        first = np.round(starts * rate).astype(np.int64)
+        stop = np.round((starts + window_seconds) * rate).astype(np.int64)
+        features = WINDOW_FEATURES[signal_type](processed_dataframes[signal_type], peaks.get(signal_type) or {}, rate, first, stop)
+        table.update({name: values.astype(SIGNAL_DTYPE) for name, values in features.items()})
+    return pd.DataFrame(table)
+
+def save_windowed_features(table: pd.DataFrame, folder, window_seconds: float, step_seconds: float, file_format: str = DEFAULT_FORMAT):
+    if not folder.exists():
+        folder.mkdir(parents=True)
+    path = save_dataframe(table, folder / f"windowed_features_{window_seconds:g}s_{step_seconds:g}s", file_format)
+    print(f"Windowed features ({len(table)} windows of {window_seconds:g} s) saved at {path}")
+    return path
+
+def main(researcher_initials: str, participant_id: str, current_date: str = None, window_seconds: float = FEATURE_WINDOW_SECONDS,
+         step_seconds: float = FEATURE_STEP_SECONDS, file_format: str = DEFAULT_FORMAT) -> pd.DataFrame:
+    '''
+    The windowed features of a run, from its interim files.
+    '''
+    from features.build_features import interim_folder, load_intermediate, load_intermediate_peaks
+    folder = interim_folder(researcher_initials, participant_id, current_date)
+    processed_dataframes = load_intermediate(researcher_initials, participant_id, current_date, WINDOWED_MODALITIES)
+    peaks = load_intermediate_peaks(researcher_initials, participant_id, current_date, WINDOWED_MODALITIES)
+    if not processed_dataframes:
+        raise FileNotFoundError(f"No processed ECG, RSP or EDA in {folder}")
+    rates = json.loads((folder / "sampling_rates.json").read_text())
+    table = windowed_features(processed_dataframes, peaks, rates["acquisition"], rates, window_seconds, step_seconds)
+    save_windowed_features(table, folder, window_seconds, step_seconds, file_format)
+    return table
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sliding-window features of a run, from its interim files.")
+    parser.add_argument("researcher_initials")
+    parser.add_argument("participant_id")
+    parser.add_argument("--date", help="Date of the run as YYYY_MM_DD (default today)")
+    parser.add_argument("--window", type=float, default=FEATURE_WINDOW_SECONDS, help=f"Window length in seconds (default {FEATURE_WINDOW_SECONDS})")
+    parser.add_argument("--step", type=float, default=FEATURE_STEP_SECONDS, help=f"Step between windows in seconds (default {FEATURE_STEP_SECONDS})")
+    args = parser.parse_args()
+    print(main(args.researcher_initials, args.participant_id, args.date, args.window, args.step).describe().T.to_string())
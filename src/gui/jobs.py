@@ -0,0 +1,126 @@
+''' Background worker running the analyses queued in the GUI.
+
+The analyses run in a worker process, so the window stays responsive and a running analysis can be
+cancelled by terminating the process (the finished stages are checkpointed, a rerun resumes from
+them). The worker imports the analysis libraries as soon as it starts, while the form is filled in,
+and keeps them loaded for the next analyses. It runs one job at a time: the GUI keeps the queue and
+sends the next job when the worker is idle, so cancelling a queued job only removes it from the
+queue. If a warm worker (python -m warm_worker) is running, the jobs are forwarded to it.
+
+The worker reports (job id, stage, status, detail) events on a queue, which the GUI polls:
+    (None, "worker", "ready", seconds to import the libraries)
+    (job id, stage or "figure <name>", "pending" | "running" | "done" | "loaded" | "failed", None)
+    (job id, "analysis", "done", path of the run report) or (job id, "analysis", "failed", traceback)
+'''
+import multiprocessing
+import os
+import queue
+import signal
+import traceback
+
+try:
+    import psutil
+except ImportError:  # without psutil the worker's process group is killed instead (POSIX only)
+    psutil = None
+
+def _work(jobs, events):
+    if hasattr(os, "setpgid"):
+        # Its own process group, shared with the pools it starts, so stop() can kill them all
+        os.setpgid(0, 0)
+    import warm_worker
+    from startup import BackgroundImport
+    seconds = 0.0 if warm_worker.is_running() else BackgroundImport().start().wait()
+    events.put((None, "worker", "ready", seconds))
+    from main import analyse
+
+    for job_id, job in iter(jobs.get, None):
+        def progress(stage, status, job_id=job_id):
+            events.put((job_id, stage, status, None))
+        try:
+            run_report_path = warm_worker.submit(job, progress=progress)
+            if run_report_path is None:
+                run_report_path = analyse(**job, progress=progress)
+            events.put((job_id, "analysis", "done", str(run_report_path)))
+        except Exception:
+            traceback.print_exc()
+            events.put((job_id, "analysis", "failed", traceback.format_exc()))
+
+class AnalysisWorker:
+    '''
+    A worker process running the submitted jobs (the keyword arguments of main.analyse) one after the other.
+    '''
+    def __init__(self):
+        # Spawned rather than forked, a fork of the process running Tk is not safe
+        self.context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.busy = False
+        self.start()
+
+    def start(self):
+        self.jobs = self.context.Queue()
+        self.events = self.context.Queue()
+        # Not a daemon, the figures are rendered on a pool of its own worker processes. The GUI stops it when closed
+        self.process = self.context.Process(target=_work, args=(self.jobs, self.events), name="analysis-worker")
+        self.process.start()
+
+    def submit(self, job_id: int, job: dict):
+        self.busy = True
+        self.jobs.put((job_id, job))
+
+    def poll(self) -> list:
+        '''
+        The events reported since the last poll.
+        '''
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        if any(stage == "analysis" for _, stage, _, _ in events):
+            self.busy = False
+        if self.busy and not self.process.is_alive():
+            # The worker crashed (e.g. out of memory), the job is reported as failed and a new worker is started
+            events.append((None, "analysis", "failed", f"The worker process exited with code {self.process.exitcode}"))
+            self.busy = False
+            self.start()
+        return events
+
+    def cancel(self):
+        '''
+        Stop the running job by terminating the worker, and start a new one for the next jobs.
+        '''
+        self.stop()
+        self.busy = False
+        self.start()
+
+    def stop(self):
+        '''
+        Terminate the worker and the processes it started (the figure and modality pools), which
+        would otherwise keep running after it.
+        '''
+        if psutil is not None:
+            try:
+                children = psutil.Process(self.process.pid).children(recursive=True)
+            except psutil.NoSuchProcess:
+                children = []
+            self.process.terminate()
+            self.process.join()
+            for child in children:
+                try:
+                    child.terminate()
+                except psutil.NoSuchProcess:
+                    pass
+            _, alive = psutil.wait_procs(children, timeout=3)
+            for child in alive:
+                child.kill()
+        elif hasattr(os, "killpg") and self.process.is_alive():
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+            except ProcessLookupError:  # stopped before it had its own group
+                pass
+            self.process.terminate()
+            self.process.join()
+        else:
+            self.process.terminate()
+            self.process.join()
@@ -1,13 +1,17 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from tkinter import ttk  # ttk (themed Tkinter) for a more modern look
-import random
+from collections import deque
+from pathlib import Path
+from gui.jobs import AnalysisWorker
+from participants import generate_participant_id
 
 class DataAnalysisGUI:
-    def __init__(self):
+    def __init__(self, startup=None):
         self.root = tk.Tk()
         self.root.title("M2B3 BIOPAC Data Analysis")
-        self.root.geometry("400x680")  # set initial window size
+        self.root.geometry("420x940")  # set initial window size
+        self.startup = startup
         
         # Initialize attributes
         self.data_file = ""
@@ -24,6 +28,14 @@ class DataAnalysisGUI:
         self.ppg = tk.BooleanVar(value=False)
         self.slider = tk.BooleanVar(value=False)
         self.rates_and_events = tk.BooleanVar(value=False)
+        self.windowed_features = tk.BooleanVar(value=False)
+
+        # Analyses queued from the window, run one after the other by the worker
+        self.worker = None
+        self.jobs = {}
+        self.pending = deque()
+        self.running = None
+        self.next_job_id = 1
 
         large_font = ("Verdana", 12)
         medium_font = ("Verdana", 10)
@@ -39,7 +51,7 @@ class DataAnalysisGUI:
         
         tk.Button(self.root, text="Browse", font=medium_font, command=self.open_file).pack(pady=5)
 
-        tk.Label(self.root, text="Sampling Rate:", font=large_font).pack(pady=10)
+        tk.Label(self.root, text="Sampling Rate (blank for .acq):", font=large_font).pack(pady=10)
         
         self.rate_entry = tk.Entry(self.root, font=medium_font)
         self.rate_entry.pack(pady=5)
@@ -62,9 +74,20 @@ class DataAnalysisGUI:
         tk.Checkbutton(self.root, text="PPG", variable=self.ppg).pack(pady=5)
         tk.Checkbutton(self.root, text="Slider", variable=self.slider).pack(pady=5)
         tk.Checkbutton(self.root, text="Rates and Events", variable=self.rates_and_events).pack(pady=5)
+        tk.Checkbutton(self.root, text="Windowed Features", variable=self.windowed_features).pack(pady=5)
         
         tk.Button(self.root, text="Let's go!", font=medium_font, command=self.validate_and_submit).pack(pady=20)
 
+        ttk.Separator(self.root, orient="horizontal").pack(fill="x", padx=10)
+        tk.Label(self.root, text="Analyses:", font=large_font).pack(pady=5)
+        self.job_list = tk.Listbox(self.root, font=medium_font, height=5, width=40)
+        self.job_list.pack(pady=5)
+        self.progress_label = tk.Label(self.root, text="Loading the analysis libraries...", font=medium_font, wraplength=380)
+        self.progress_label.pack(pady=5)
+        self.progress_bar = ttk.Progressbar(self.root, orient="horizontal", length=300, mode="determinate")
+        self.progress_bar.pack(pady=5)
+        tk.Button(self.root, text="Cancel", font=medium_font, command=self.cancel).pack(pady=5)
+
     def open_file(self):
         file_path = filedialog.askopenfilename(filetypes=[("MAT files", "*.mat"), ("ACQ files", "*.acq")])
         self.file_entry.delete(0, tk.END)
@@ -84,7 +107,11 @@ class DataAnalysisGUI:
         else:
             self.file_entry.config(bg='white')
 
-        if not rate_str:
+        if not rate_str and self.data_file.lower().endswith(".acq"):
+            # .acq files carry their native rate, as in batch.py
+            self.rate_entry.config(bg='white')
+            self.sampling_rate = None
+        elif not rate_str:
             self.rate_entry.config(bg='red')
             validation_pass = False
         else:
@@ -112,40 +139,132 @@ class DataAnalysisGUI:
         else:
             # This is where you could generate the participant ID
             self.participant_id = self.generate_participant_id(self.participant_name)
-            self.root.quit()
+            self.queue_analysis()
 
-    def submit(self):
-        self.data_file = self.file_entry.get()
-        self.sampling_rate = int(self.rate_entry.get())
-        self.researcher_initials = self.initials_entry.get()
-        self.participant_name = self.name_entry.get()
-        
-        # Generate the unique participant ID
-        self.participant_id = self.generate_participant_id(self.participant_name)
-        
-        self.root.quit()
+    def queue_analysis(self):
+        outputs = {"HRV": self.HRV.get(), "excel_table": self.excel_table.get(), "ecg": self.ecg.get(), "rsp": self.rsp.get(),
+                   "eda": self.eda.get(), "ppg": self.ppg.get(), "slider": self.slider.get(), "rates_and_events": self.rates_and_events.get(),
+                   "windowed_features": self.windowed_features.get()}
+        job = {"data_file": self.data_file, "sampling_rate": self.sampling_rate, "researcher_initials": self.researcher_initials,
+               "participant_id": self.participant_id, "outputs": outputs}
+        if self.startup is not None and self.next_job_id == 1:
+            # The startup times are saved in the run report of the first analysis
+            self.startup.mark("first_submitted_s")
+            job["startup"] = self.startup.times
+        print("Participant name and ID:", self.participant_name, self.participant_id)
 
-    def generate_participant_id(self, participant_name):
-        # Create a unique participant ID based on the participant's name
-        random_id = random.randint(1000, 9999)
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        self.jobs[job_id] = {"job": job, "status": "queued", "stages": {}}
+        self.pending.append(job_id)
+        # The next recording is entered in the same form
+        self.file_entry.delete(0, tk.END)
+        self.name_entry.delete(0, tk.END)
+        self.show_jobs()
 
-        # Create a unique participant ID based on the participant's name and random ID
-        participant_id = f"{participant_name[:2].upper()}{random_id}"
-        
-        return participant_id
+    def show_jobs(self):
+        self.job_list.delete(0, tk.END)
+        for job_id, entry in self.jobs.items():
+            job = entry["job"]
+            self.job_list.insert(tk.END, f"{job['participant_id']}  {Path(job['data_file']).name}  {entry['status']}")
+
+    def show_progress(self):
+        entry = self.jobs[self.running]
+        stages = entry["stages"]
+        finished = sum(status in ("done", "loaded") for status in stages.values())
+        running = [stage for stage, status in stages.items() if status == "running"]
+        self.progress_bar["value"] = 100 * finished / len(stages) if stages else 0
+        self.progress_label.config(text=f"{entry['job']['participant_id']}: {', '.join(running) or 'starting'} ({finished}/{len(stages)} steps)")
+
+    def start_next(self):
+        self.running = self.pending.popleft()
+        self.jobs[self.running]["status"] = "running"
+        self.worker.submit(self.running, self.jobs[self.running]["job"])
+        self.show_jobs()
+        self.show_progress()
+
+    def finish(self, status, detail):
+        entry = self.jobs[self.running]
+        entry["status"] = status
+        self.running = None
+        self.show_jobs()
+        if status == "done":
+            self.progress_bar["value"] = 100
+            self.progress_label.config(text=f"{entry['job']['participant_id']}: analysis complete")
+            print(f"Run report saved at {detail}")
+            print("Analysis complete!")
+        else:
+            self.progress_bar["value"] = 0
+            self.progress_label.config(text=f"{entry['job']['participant_id']}: analysis failed")
+            messagebox.showerror("Analysis failed", detail.strip().splitlines()[-1])
+
+    def poll_worker(self):
+        for job_id, stage, status, detail in self.worker.poll():
+            if stage == "worker":
+                if self.startup is not None and "worker_ready_s" not in self.startup.times:
+                    self.startup.mark("worker_ready_s")
+                    self.startup.record("worker_import_s", detail)
+                    print(f"Startup: window shown after {self.startup.times['window_shown_s']:.2f} s, analysis libraries "
+                          f"loaded in the worker {self.startup.times['worker_ready_s']:.1f} s after the start")
+                if self.running is None:
+                    self.progress_label.config(text="Ready")
+                continue
+            # Events without a job id come from a worker that crashed, events of a cancelled job are dropped
+            if self.running is None or job_id not in (None, self.running):
+                continue
+            if stage == "analysis":
+                self.finish(status, detail)
+            else:
+                self.jobs[self.running]["stages"][stage] = status
+                self.show_progress()
+        if self.running is None and self.pending:
+            self.start_next()
+        self.root.after(100, self.poll_worker)
+
+    def cancel(self):
+        '''
+        Cancel the selected analysis, or the running one if none is selected.
+        '''
+        selection = self.job_list.curselection()
+        job_id = list(self.jobs)[selection[0]] if selection else self.running
+        if job_id is None or self.jobs[job_id]["status"] not in ("queued", "running"):
+            return
+        if job_id == self.running:
+            # The stages that finished are checkpointed, running the same recording again resumes from them
+            self.worker.cancel()
+            self.running = None
+            self.progress_bar["value"] = 0
+            self.progress_label.config(text="Cancelled, restarting the worker...")
+        else:
+            self.pending.remove(job_id)
+        self.jobs[job_id]["status"] = "cancelled"
+        self.show_jobs()
+
+    def start_worker(self):
+        if self.startup is not None:
+            self.startup.mark("window_shown_s")
+        # Started once the window is shown, the worker imports the analysis libraries while the form is filled in
+        self.worker = AnalysisWorker()
+        self.poll_worker()
+
+    def close(self):
+        unfinished = self.running is not None or self.pending
+        if unfinished and not messagebox.askyesno("Quit", "Analyses are still running or queued. Cancel them and quit?"):
+            return
+        self.root.destroy()
+
+    def generate_participant_id(self, participant_name):
+        return generate_participant_id(participant_name)
 
     def run(self):
-        self.root.mainloop()
-        print("Participant name and ID:", self.participant_name, self.participant_id)
-        return (
-            self.data_file, 
-            self.sampling_rate, 
-            self.researcher_initials, 
-            self.participant_name, 
-            self.participant_id,
-            self.HRV.get(), self.excel_table.get(), self.ecg.get(), self.rsp.get(), self.eda.get(), self.ppg.get(), self.slider.get(), self.rates_and_events.get()
-        )
-
-def main():
-    gui_instance = DataAnalysisGUI()
-    return gui_instance.run()
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.root.after_idle(self.start_worker)
+        try:
+            self.root.mainloop()
+        finally:
+            if self.worker is not None and self.worker.process.is_alive():
+                self.worker.stop()
+
+def main(startup=None):
+    gui_instance = DataAnalysisGUI(startup)
+    gui_instance.run()
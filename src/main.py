@@ -1,18 +1,44 @@
-from gui.run_gui import main as run_gui
-# Initialize the GUI and get the input values # set\dict for true false # set of enum values
-data_file, sampling_rate, researcher_initials, participant_name, participant_id, HRV, excel_table, ecg, rsp, eda, ppg, slider, rates_and_events = run_gui()
-
-from read.make_dataset import main as make_dataset
-# Make the dataset and receive the DataFrame and sampling rate
-df = make_dataset(data_file, sampling_rate, researcher_initials, participant_id)
-
-from features.build_features import main as build_features
-# Build features using the received DataFrame and sampling rate
-processed_dataframes, events = build_features(df, sampling_rate, researcher_initials, participant_id)
-
-from visualization.visualize import main as visualize
-# Visualize the data using the received DataFrame, sampling rate, and other input values
-visualize(df, processed_dataframes, sampling_rate, researcher_initials, participant_id, events, HRV, excel_table, ecg, rsp, eda, ppg, slider, rates_and_events)
+def analyse(data_file, sampling_rate, researcher_initials, participant_id, outputs, startup=None, progress=None):
+    '''
+    The analysis of the GUI, run by its worker process or by the warm worker (see gui/jobs.py and warm_worker.py).
+    progress(stage, status) is called as the stages and figures are run. Returns the path of the run report.
+    '''
+    from profiling import StageProfiler
+    from pipeline import run_analysis
+    from features.build_features import interim_folder
+    from features.cache import ProcessedSignalCache
+    from features.resample import DEFAULT_SAMPLING_RATES
+    # Time every stage of the pipeline, the report is saved with the interim outputs
+    profiler = StageProfiler()
+    if startup:
+        profiler.metadata["startup"] = startup
+
+    # The analysis runs as a graph of stages (load -> process per modality -> events -> interval analysis -> figures)
+    # whose results are checkpointed in data/checkpoints, so a rerun only computes the stages whose inputs, parameters
+    # or code changed, e.g. only the figures after a crash while plotting (see pipeline.py)
+    # Only the channels and modalities the checked outputs need are loaded and processed, in parallel threads
+    # Processed signals are also cached per recording, so rerunning the same file under another participant skips the processing
+    # EDA, RSP and the slider are decimated to 100 Hz before processing, ECG and PPG keep the acquisition rate
+    # Recordings of more than an hour are processed in overlapping windows so they fit in memory
+    # The events come from the study's protocol file in features/protocols (the BAK pilot by default), with the
+    # onsets detected from the 0/9 markers in the slider. They are saved in events.csv with the interim files to check them
+    # Figures are rendered headless in parallel worker processes and collected in a report that opens when done
+    run_analysis(data_file, sampling_rate, researcher_initials, participant_id, outputs, detect_events=True, chunk_seconds="auto",
+                 executor="thread", cache=ProcessedSignalCache(), headless=True, open_report=True, profiler=profiler,
+                 sampling_rates=DEFAULT_SAMPLING_RATES, progress=progress)
+
+    return profiler.save(interim_folder(researcher_initials, participant_id))
+
+# Worker processes import this module, only the main process runs the GUI
+if __name__ == '__main__':
+    from startup import StartupTimer
+    from gui.run_gui import main as run_gui
+    startup = StartupTimer()
+    # Only Tkinter is loaded before the window appears. The analyses submitted in the window are queued and run one
+    # after the other by a worker process (see gui/jobs.py), which imports the analysis libraries while the form is
+    # filled in and keeps them loaded, or forwards them to a warm worker (python -m warm_worker) if one is running.
+    # The window shows the progress of every stage and figure, and the running or queued analyses can be cancelled
+    run_gui(startup)
 
 ''' The following lines are commented out because they are not yet implemented
 #from models.train_model import run as train_model
@@ -26,5 +52,3 @@ visualize(df, processed_dataframes, sampling_rate, researcher_initials, particip
 #predict_model()
 '''
 
-print("Analysis complete!")
-
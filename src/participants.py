@@ -0,0 +1,25 @@
+''' Participant IDs.
+
+The GUI gives every participant a new random ID (two letters of the name and 4 digits). Batch runs
+need the same ID for the same recording on every run, so a rerun reuses its checkpoints and output
+folders and the group table counts it once: stable_participant_id derives it from the name.
+'''
+import hashlib
+import random
+
+def generate_participant_id(participant_name):
+    # Create a unique participant ID based on the participant's name
+    random_id = random.randint(1000, 9999)
+
+    # Create a unique participant ID based on the participant's name and random ID
+    participant_id = f"{participant_name[:2].upper()}{random_id}"
+
+    return participant_id
+
+def stable_participant_id(participant_name: str) -> str:
+    '''
+    The same ID for the same name on every run: two letters of the name and 8 digits of its hash
+    (more than the GUI's 4, so the recordings of a large batch don't collide).
+    '''
+    digest = int(hashlib.sha256(participant_name.encode()).hexdigest(), 16)
+    return f"{participant_name[:2].upper()}{digest % 10 ** 8:08d}"
@@ -0,0 +1,366 @@
+''' Resumable pipeline: the analysis of a recording as a graph of checkpointed stages.
+
+    load -> process_<modality> -> events -> save_features, hrv_per_event, interval_analysis -> excel_table -> figures
+
+Every stage has a fingerprint, the hash of its parameters, of the source of the modules it runs and
+of the fingerprints of the stages it depends on (load depends on the content of the recording).
+Results are checkpointed with their fingerprint in data/checkpoints/<recording>_<content hash>, and
+a rerun only computes the stages whose fingerprint changed, loading the checkpoints of the others
+where they are needed. A crash while plotting doesn't redo the loading and processing, and after a
+bug fix only the stages running the fixed module (and the stages after them) are computed again.
+Stages writing files named after the participant and date (interim files, tables, figures) also
+depend on these, so a run under another participant ID or on another day writes them again.
+'''
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+
+import neurokit2 as nk
+import numpy as np
+import pandas as pd
+
+from read.make_dataset import main as make_dataset
+from read.storage import save_dataframe, load_dataframe, DEFAULT_FORMAT
+from features.build_features import FeatureBuilder, EXECUTORS, COLUMN_LABELS, save_features, interim_folder
+from features.cache import ProcessedSignalCache, source_hash
+from features.chunked import AUTO_CHUNK_SECONDS, DEFAULT_WINDOW_SECONDS
+from features.protocol import load_protocol, DEFAULT_PROTOCOL
+from features.resample import modality_rate, resample_events
+from features.windowed import windowed_features, save_windowed_features, FEATURE_WINDOW_SECONDS, FEATURE_STEP_SECONDS, WINDOWED_MODALITIES
+from visualization.visualize import HRVPlot, SaveExcelTableAndPlotBars, figure_tasks, render_figures
+from profiling import NullProfiler
+
+def no_progress(stage: str, status: str):
+    pass
+
+OUTPUT_FLAGS = ["HRV", "excel_table", "ecg", "rsp", "eda", "ppg", "slider", "rates_and_events", "windowed_features"]
+SIGNAL_TYPES = list(COLUMN_LABELS)
+# Modalities each output needs
+OUTPUT_MODALITIES = {
+    "HRV": ["ecg"],
+    "excel_table": ["eda", "ecg", "rsp"],
+    "ecg": ["ecg"],
+    "rsp": ["rsp"],
+    "eda": ["eda"],
+    "ppg": ["ppg"],
+    "slider": ["slider"],
+    "rates_and_events": ["ecg", "rsp", "eda", "slider"],
+    "windowed_features": WINDOWED_MODALITIES,
+}
+
+def required_modalities(outputs: dict) -> list:
+    requested = {signal_type for flag, signal_types in OUTPUT_MODALITIES.items() if outputs.get(flag) for signal_type in signal_types}
+    return [signal_type for signal_type in SIGNAL_TYPES if signal_type in requested]
+
+def plan(outputs: dict, detect_events: bool = False) -> tuple:
+    '''
+    (modalities to process, channels to load) for the requested outputs, so the other channels are
+    never read. Without any output every modality is processed, the interim files are the output then.
+    The slider channel is also loaded when the event onsets are detected from it.
+    '''
+    signal_types = required_modalities(outputs) or list(SIGNAL_TYPES)
+    channels = [COLUMN_LABELS[signal_type] for signal_type in SIGNAL_TYPES
+                if signal_type in signal_types or (signal_type == "slider" and detect_events)]
+    return signal_types, channels
+
+def checkpoint_folder(data_file: Path, recording_hash: str) -> Path:
+    # Per recording and not per participant, the batch generates a new participant ID on every run
+    script_dir = Path(__file__).resolve().parent
+    return script_dir.parent / "data" / "checkpoints" / f"{Path(data_file).stem}_{recording_hash[:12]}"
+
+def _json_default(value):
+    # Protocol onsets and other arrays are hashed by value
+    return value.tolist() if isinstance(value, np.ndarray) else str(value)
+
+def _is_numeric(df: pd.DataFrame) -> bool:
+    return all(dtype.kind in "biuf" for dtype in df.dtypes) and all(isinstance(name, str) for name in df.columns)
+
+def _save_result(result, path: Path) -> dict:
+    # Numeric DataFrames (signals) are saved as Parquet, the rest (peak indices, events, result tables) is pickled
+    if isinstance(result, pd.DataFrame) and _is_numeric(result):
+        return {"dataframe": save_dataframe(result, path, "parquet").name}
+    if isinstance(result, tuple):
+        return {"tuple": [_save_result(item, path.with_name(f"{path.name}_{i}")) for i, item in enumerate(result)]}
+    pickle_path = path.with_suffix(".pkl")
+    with open(pickle_path, "wb") as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return {"pickle": pickle_path.name}
+
+def _load_result(saved: dict, folder: Path):
+    if "dataframe" in saved:
+        return load_dataframe(folder / saved["dataframe"])
+    if "tuple" in saved:
+        return tuple(_load_result(item, folder) for item in saved["tuple"])
+    with open(folder / saved["pickle"], "rb") as f:
+        return pickle.load(f)
+
+def _files(saved: dict) -> list:
+    if "tuple" in saved:
+        return [name for item in saved["tuple"] for name in _files(item)]
+    return list(saved.values())
+
+class Checkpoints:
+    '''
+    Results of the stages of one participant, with the fingerprint they were computed for, listed in manifest.json.
+    '''
+    def __init__(self, folder: Path):
+        self.folder = Path(folder)
+        self.manifest_path = self.folder / "manifest.json"
+        self.manifest = json.loads(self.manifest_path.read_text()) if self.manifest_path.exists() else {}
+        self._lock = threading.Lock()  # stages finish in parallel threads
+
+    def has(self, name: str, fingerprint: str) -> bool:
+        entry = self.manifest.get(name)
+        return entry is not None and entry["fingerprint"] == fingerprint and all((self.folder / file).exists() for file in _files(entry["result"]))
+
+    def load(self, name: str):
+        return _load_result(self.manifest[name]["result"], self.folder)
+
+    def save(self, name: str, fingerprint: str, result):
+        with self._lock:
+            # Forget the old result first, so a crash while writing never leaves an entry pointing at half-written files
+            if self.manifest.pop(name, None) is not None:
+                self._write_manifest()
+        if not self.folder.exists():
+            self.folder.mkdir(parents=True, exist_ok=True)
+        saved = _save_result(result, self.folder / name)
+        with self._lock:
+            self.manifest[name] = {"fingerprint": fingerprint, "result": saved, "saved_at": datetime.now().isoformat(timespec="seconds")}
+            self._write_manifest()
+
+    def _write_manifest(self):
+        if not self.folder.exists():
+            self.folder.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.manifest, indent=2))
+        os.replace(tmp_path, self.manifest_path)
+
+class Pipeline:
+    '''
+    Graph of stages. A stage is a function of the {stage name: result} dict of the stages it requires,
+    its params and code (module names) go into its fingerprint. Independent stages run in parallel threads.
+    progress(stage, status) is called as the stages are "pending", "running", "done", "loaded" or "failed".
+    '''
+    def __init__(self, checkpoints: Checkpoints = None, profiler=None, max_workers: int = None, progress=None):
+        self.checkpoints = checkpoints
+        self.profiler = profiler or NullProfiler()
+        self.progress = progress or no_progress
+        self.max_workers = max_workers
+        self.stages = {}
+        self._fingerprints = {}
+
+    def add(self, name: str, func, requires: list = (), params: dict = None, code: list = ()):
+        missing = [required for required in requires if required not in self.stages]
+        if missing:
+            raise ValueError(f"Stage {name} requires unknown stages {missing}, add them first")
+        self.stages[name] = {"func": func, "requires": list(requires), "params": params or {}, "code": list(code)}
+
+    def fingerprint(self, name: str) -> str:
+        if name not in self._fingerprints:
+            stage = self.stages[name]
+            content = json.dumps({
+                "stage": name,
+                "params": stage["params"],
+                "code": {module_name: source_hash(module_name) for module_name in stage["code"]},
+                "requires": {required: self.fingerprint(required) for required in stage["requires"]},
+            }, sort_keys=True, default=_json_default)
+            self._fingerprints[name] = hashlib.sha256(content.encode()).hexdigest()
+        return self._fingerprints[name]
+
+    def _run_stage(self, name: str, results: dict):
+        stage = self.stages[name]
+        self.progress(name, "running")
+        with self.profiler.stage(name) as metrics:
+            metrics["checkpoint"] = "computed"
+            result = stage["func"]({required: results[required] for required in stage["requires"]})
+        if self.checkpoints is not None:
+            self.checkpoints.save(name, self.fingerprint(name), result)
+        self.progress(name, "done")
+        return result
+
+    def _load_stage(self, name: str):
+        start = time.perf_counter()
+        result = self.checkpoints.load(name)
+        self.profiler.record(name, wall_time_s=time.perf_counter() - start, checkpoint="loaded")
+        self.progress(name, "loaded")
+        return result
+
+    def _run_level(self, names: list, to_run: list, results: dict, pool):
+        # Yields (name, result or exception). A single stage runs in this thread, figures shown in a window need the main thread
+        def run_or_load(name):
+            return self._run_stage(name, results) if name in to_run else self._load_stage(name)
+        if len(names) == 1 or self.max_workers == 1:
+            for name in names:
+                try:
+                    yield name, run_or_load(name)
+                except Exception as error:
+                    yield name, error
+            return
+        futures = {name: pool.submit(run_or_load, name) for name in names}
+        for name, future in futures.items():
+            try:
+                yield name, future.result()
+            except Exception as error:
+                yield name, error
+
+    def run(self) -> dict:
+        '''
+        Compute the stages that are out of date and return the results of every stage that was computed or loaded.
+        '''
+        to_run = [name for name in self.stages if self.checkpoints is None or not self.checkpoints.has(name, self.fingerprint(name))]
+        # Up to date stages are only loaded when a stage to run needs their result
+        to_load = {required for name in to_run for required in self.stages[name]["requires"]} - set(to_run)
+        print(f"Pipeline: {len(self.stages) - len(to_run)} stages up to date, running {', '.join(to_run) or 'nothing'}")
+        for name in self.stages:
+            if name in to_run or name in to_load:
+                self.progress(name, "pending")
+
+        # Stages of the same level only depend on earlier levels, so they can run at the same time
+        levels = {}
+        for name, stage in self.stages.items():
+            levels[name] = 1 + max((levels[required] for required in stage["requires"]), default=-1)
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for level in range(max(levels.values(), default=-1) + 1):
+                names = [name for name in self.stages if levels[name] == level and (name in to_run or name in to_load)]
+                errors = []
+                for name, result in self._run_level(names, to_run, results, pool):
+                    if isinstance(result, Exception):
+                        self.progress(name, "failed")
+                        errors.append(result)
+                    else:
+                        results[name] = result
+                # The stages that finished are checkpointed, the next run starts from them
+                if errors:
+                    raise errors[0]
+        return results
+
+def run_analysis(data_file: Path, sampling_rate: int, researcher_initials: str, participant_id: str, outputs: dict,
+                 protocol: str = DEFAULT_PROTOCOL, detect_events: bool = False, chunk_seconds=None, executor: str = None,
+                 max_workers: int = None, file_format: str = DEFAULT_FORMAT, cache: ProcessedSignalCache = None, headless: bool = True,
+                 render_workers: int = None, open_report: bool = False, profiler=None, use_checkpoints: bool = True,
+                 sampling_rates: dict = None, progress=None, feature_windows: tuple = None) -> dict:
+    '''
+    make_dataset -> build_features -> visualize as a resumable pipeline. outputs are the flags of the
+    tables and figures (see OUTPUT_FLAGS). chunk_seconds="auto" processes recordings of more than
+    AUTO_CHUNK_SECONDS in windows. Only the channels and modalities the outputs need are loaded and
+    processed (see plan). With an executor ("thread" or "process") the modalities are
+    processed in parallel on a pool of its kind. sampling_rates are the target rates of the modalities
+    to resample before processing (see features.resample). progress(stage, status) is called as the
+    stages and figures are run (see Pipeline). feature_windows is the (window, step) in seconds of the
+    windowed features (see features.windowed).
+    '''
+    profiler = profiler or NullProfiler()
+    data_file = Path(data_file)
+    outputs = {flag: bool(outputs.get(flag)) for flag in OUTPUT_FLAGS}
+    signal_types, channels = plan(outputs, detect_events)
+    print(f"Processing {', '.join(signal_types)} from {len(channels)} of {len(COLUMN_LABELS)} channels")
+    recording_hash = (cache or ProcessedSignalCache()).file_hash(data_file)
+    checkpoints = Checkpoints(checkpoint_folder(data_file, recording_hash)) if use_checkpoints else None
+    # Parameters of the stages that write files named after the run
+    run_name = {"researcher_initials": researcher_initials, "participant_id": participant_id, "date": datetime.now().strftime("%Y_%m_%d")}
+
+    with EXECUTORS[executor](max_workers=max_workers) if executor else nullcontext() as pool:
+        pipeline = Pipeline(checkpoints, profiler, max_workers=len(signal_types) if executor else 1, progress=progress)
+
+        def load(inputs):
+            df, loaded_rate = make_dataset(data_file, sampling_rate, researcher_initials, participant_id, channels=channels,
+                                           file_format=file_format, profiler=profiler)
+            if not loaded_rate:
+                raise ValueError("No sampling rate given for a .mat recording")
+            return df, loaded_rate
+        pipeline.add("load", load, params={"recording": recording_hash, "sampling_rate": sampling_rate, "channels": channels},
+                     code=["read.make_dataset", "read.dtypes", "read.storage"])
+
+        def builder(df, loaded_rate):
+            window_seconds = chunk_seconds
+            if chunk_seconds == "auto":
+                # Recordings of more than an hour are processed in overlapping windows so they fit in memory
+                window_seconds = DEFAULT_WINDOW_SECONDS if len(df) / loaded_rate > AUTO_CHUNK_SECONDS else None
+            return FeatureBuilder(df, loaded_rate, COLUMN_LABELS, cache, data_file, profiler, protocol, detect_events, window_seconds,
+                                  sampling_rates=sampling_rates)
+
+        for signal_type in signal_types:
+            def process(inputs, signal_type=signal_type):
+                return builder(*inputs["load"]).process_signal(signal_type, pool)
+            pipeline.add(f"process_{signal_type}", process, requires=["load"],
+                         params={"column_label": COLUMN_LABELS[signal_type], "neurokit": nk.__version__, "chunk_seconds": chunk_seconds,
+                                 "target_rate": (sampling_rates or {}).get(signal_type)},
+                         code=["features.build_features", "features.chunked", "features.peak_index", "features.resample", "read.dtypes"])
+
+        pipeline.add("events", lambda inputs: builder(*inputs["load"]).create_events(), requires=["load"],
+                     params={"protocol": vars(load_protocol(protocol)), "detect_events": detect_events},
+                     code=["features.build_features", "features.protocol", "features.event_detection"])
+
+        processed_stages = [f"process_{signal_type}" for signal_type in signal_types]
+
+        def processed(inputs):
+            return ({signal_type: inputs[f"process_{signal_type}"][0] for signal_type in SIGNAL_TYPES if f"process_{signal_type}" in inputs},
+                    {signal_type: inputs[f"process_{signal_type}"][1] for signal_type in SIGNAL_TYPES if f"process_{signal_type}" in inputs})
+
+        def save(inputs):
+            save_features(*processed(inputs), inputs["events"], inputs["load"][1], researcher_initials, participant_id, file_format, profiler,
+                          sampling_rates)
+        pipeline.add("save_features", save, requires=["load", "events"] + processed_stages,
+                     params={"file_format": file_format, **run_name}, code=["features.build_features", "features.resample", "read.storage"])
+
+        if outputs["HRV"]:
+            def hrv_per_event(inputs):
+                rpeaks = inputs["process_ecg"][1]["ECG_R_Peaks"]
+                ecg_rate = modality_rate(inputs["load"][1], sampling_rates, "ecg")
+                hrv_plot = HRVPlot(rpeaks, len(inputs["process_ecg"][0]), ecg_rate, researcher_initials, participant_id, headless)
+                hrv_df = hrv_plot.hrv_per_event(resample_events(inputs["events"], inputs["load"][1], ecg_rate, hrv_plot.n_samples))
+                hrv_plot.save2path(hrv_df)
+                return hrv_df
+            pipeline.add("hrv_per_event", hrv_per_event, requires=["load", "process_ecg", "events"],
+                         params={"neurokit": nk.__version__, **run_name}, code=["visualization.visualize", "features.protocol", "features.resample"])
+
+        if outputs["excel_table"]:
+            analyzed_stages = ["process_eda", "process_ecg", "process_rsp"]
+
+            def interval_analysis(inputs):
+                processed_dataframes, peaks = processed(inputs)
+                excel_table_obj = SaveExcelTableAndPlotBars(processed_dataframes, inputs["events"], inputs["load"][1], researcher_initials, participant_id,
+                                                            executor, max_workers, peaks, sampling_rates)
+                return excel_table_obj.analysis_data_signals()
+            pipeline.add("interval_analysis", interval_analysis, requires=["load", "events"] + analyzed_stages,
+                         params={"neurokit": nk.__version__}, code=["visualization.visualize", "features.protocol", "features.peak_index", "features.resample"])
+
+            def excel_table(inputs):
+                excel_table_obj = SaveExcelTableAndPlotBars({}, inputs["events"], None, researcher_initials, participant_id)
+                excel_table_obj.save2path(*inputs["interval_analysis"], "excel_table")
+                excel_table_obj.save_long(*inputs["interval_analysis"])
+            pipeline.add("excel_table", excel_table, requires=["events", "interval_analysis"],
+                         params=run_name, code=["visualization.visualize", "analysis.group_analysis"])
+
+        if outputs["windowed_features"]:
+            window_seconds, step_seconds = feature_windows or (FEATURE_WINDOW_SECONDS, FEATURE_STEP_SECONDS)
+
+            def windowed(inputs):
+                table = windowed_features(*processed(inputs), inputs["load"][1], sampling_rates, window_seconds, step_seconds)
+                save_windowed_features(table, interim_folder(researcher_initials, participant_id), window_seconds, step_seconds, file_format)
+            pipeline.add("windowed_features", windowed, requires=["load"] + [f"process_{signal_type}" for signal_type in WINDOWED_MODALITIES],
+                         params={"window_seconds": window_seconds, "step_seconds": step_seconds, "file_format": file_format, **run_name},
+                         code=["features.windowed", "features.resample"])
+
+        figure_flags = {flag: outputs[flag] for flag in ["HRV", "ecg", "rsp", "eda", "ppg", "slider", "rates_and_events"]}
+        if any(figure_flags.values()) or outputs["excel_table"]:
+            def figures(inputs):
+                render_tasks = figure_tasks(inputs["load"][0][[]], *processed(inputs), inputs["load"][1], researcher_initials, participant_id, inputs["events"],
+                                            **figure_flags, analysis_tables=inputs.get("interval_analysis"), headless=headless,
+                                            sampling_rates=sampling_rates)
+                render_figures(render_tasks, researcher_initials, participant_id, headless, render_workers, open_report, profiler, progress)
+            figure_stages = [f"process_{signal_type}" for signal_type in required_modalities(figure_flags)]
+            pipeline.add("figures", figures, requires=["load", "events"] + figure_stages + (["interval_analysis"] if outputs["excel_table"] else []),
+                         params={**figure_flags, "excel_table": outputs["excel_table"], "headless": headless, **run_name},
+                         code=["visualization.visualize", "visualization.decimate", "features.peak_index", "features.resample"])
+
+        return pipeline.run()
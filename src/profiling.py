@@ -0,0 +1,165 @@
+''' Per-stage instrumentation of the pipeline.
+
+StageProfiler records wall time, CPU time, peak RSS and bytes written for every stage and saves
+them as a JSON run report (run_report.json) next to the interim outputs, so regressions can be
+tracked when NeuroKit or the recordings change. Optionally every stage is also profiled with
+cProfile (or pyinstrument, if installed) and the dumps are written to profile_dir.
+'''
+import cProfile
+import json
+import platform
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import psutil
+except ImportError:  # RSS and I/O are only measured when psutil is installed
+    psutil = None
+
+
+def timed(func, *args, **kwargs):
+    '''
+    Call func and return (result, wall time, CPU time of the calling thread), so work running
+    in a worker thread or process can be timed where it runs and recorded afterwards.
+    '''
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - wall_start, time.thread_time() - cpu_start
+
+
+class _PeakRSSSampler:
+    # Samples the resident set size in the background while a stage runs
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._process = psutil.Process() if psutil else None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self._process:
+            self.peak = self._process.memory_info().rss
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._process:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, self._process.memory_info().rss)
+
+
+def _io_write_bytes():
+    # Not available on macOS
+    if psutil is None or not hasattr(psutil.Process, "io_counters"):
+        return None
+    return psutil.Process().io_counters().write_bytes
+
+
+class StageProfiler:
+    def __init__(self, profile_dir: Path = None, profiler: str = "cprofile"):
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.profiler = profiler
+        self.metadata = {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+        }
+        self.stages = []
+        self._lock = threading.Lock()  # stages can be recorded from worker threads
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        '''
+        Time the block as stage name. The yielded dict can be updated with extra metrics, e.g.
+        stage["bytes_written"] += path.stat().st_size for the files the stage writes.
+        CPU time is that of the whole process, so it includes stages running at the same time.
+        '''
+        metrics = {"bytes_written": 0}
+        io_start = _io_write_bytes()
+        dump = self._start_dump()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            with _PeakRSSSampler() as rss:
+                yield metrics
+        finally:
+            wall_time, cpu_time = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            self._stop_dump(dump, name)
+            io_end = _io_write_bytes()
+            self.record(name, wall_time_s=wall_time, cpu_time_s=cpu_time,
+                        peak_rss_bytes=rss.peak or None,
+                        io_write_bytes=io_end - io_start if io_start is not None else None,
+                        **metrics)
+
+    def record(self, name: str, **metrics):
+        with self._lock:
+            self.stages.append({"stage": name, **metrics})
+
+    def _start_dump(self):
+        if self.profile_dir is None:
+            return None
+        if self.profiler == "pyinstrument":
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # another stage is already being profiled (stages running in parallel)
+            return None
+        return profiler
+
+    def _stop_dump(self, profiler, name):
+        if profiler is None:
+            return
+        if not self.profile_dir.exists():
+            self.profile_dir.mkdir(parents=True)
+        file_name = re.sub(r"[^\w.-]", "_", name)
+        if self.profiler == "pyinstrument":
+            profiler.stop()
+            (self.profile_dir / f"{file_name}.html").write_text(profiler.output_html())
+        else:
+            profiler.disable()
+            profiler.dump_stats(self.profile_dir / f"{file_name}.prof")
+
+    def report(self) -> dict:
+        peak_rss = [stage["peak_rss_bytes"] for stage in self.stages if stage.get("peak_rss_bytes")]
+        return {
+            **self.metadata,
+            "total_wall_time_s": time.perf_counter() - self._start,
+            "peak_rss_bytes": max(peak_rss) if peak_rss else None,
+            "bytes_written": sum(stage.get("bytes_written") or 0 for stage in self.stages),
+            "stages": self.stages,
+        }
+
+    def save(self, folder: Path) -> Path:
+        if not folder.exists():
+            folder.mkdir(parents=True)
+        report_path = folder / "run_report.json"
+        report_path.write_text(json.dumps(self.report(), indent=2, default=str))
+        return report_path
+
+
+class NullProfiler:
+    # Same interface as StageProfiler, used when no profiling is asked for
+    def __init__(self):
+        self.metadata = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        yield {"bytes_written": 0}
+
+    def record(self, name: str, **metrics):
+        pass
@@ -0,0 +1,34 @@
+''' Memory policy for the signal DataFrames.
+
+BIOPAC channels are digitized with at most 16 bits, so float32 keeps them exactly and halves
+the memory of float64. NeuroKit adds many columns that are really 0/1 markers (ECG_R_Peaks,
+SCR_Peaks, ...) stored as int64: these become int8. Phases (RSP_Phase, ECG_Phase_Atrial) are
+0/1 with NaN before the first cycle, so they stay float (float32) to keep the NaN.
+'''
+import numpy as np
+import pandas as pd
+
+SIGNAL_DTYPE = np.float32
+MARKER_DTYPE = np.int8
+
+def compact_dtype(values) -> np.dtype:
+    '''
+    The dtype values (a column) are stored in: float32 for floats, int8 for small integers.
+    '''
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        return np.dtype(SIGNAL_DTYPE)
+    if values.dtype.kind in 'iub' and (len(values) == 0 or (values.min() >= np.iinfo(MARKER_DTYPE).min and values.max() <= np.iinfo(MARKER_DTYPE).max)):
+        return np.dtype(MARKER_DTYPE)
+    return values.dtype
+
+def compact(df: pd.DataFrame) -> pd.DataFrame:
+    # Columns already in their compact dtype are not copied
+    dtypes = {name: compact_dtype(df[name].to_numpy()) for name in df.columns}
+    return df.astype({name: dtype for name, dtype in dtypes.items() if df[name].dtype != dtype}, copy=False)
+
+def memory_bytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=False).sum()) if df is not None else 0
+
+def megabytes(n_bytes: int) -> str:
+    return f"{n_bytes / 1024 ** 2:.1f} MB"
@@ -1,56 +1,152 @@
 import logging
 from pathlib import Path
 from scipy.io import loadmat
+import bioread
+import h5py
 import numpy as np
 import pandas as pd
 from dotenv import find_dotenv, load_dotenv
 import os
 from datetime import datetime
+from read.storage import save_dataframe, DEFAULT_FORMAT
+from read.dtypes import SIGNAL_DTYPE, memory_bytes, megabytes
+from profiling import NullProfiler
 
-# if acq file -> load acq file -> data, sampling_rate = nk.read_acqknowledge('file.acq') 
 class DataPreparation:
-    def __init__(self, filepath: Path, sampling_rate: int):
+    def __init__(self, filepath: Path, sampling_rate: int, channels: list = None):
         self.filepath = filepath
         self.sampling_rate = sampling_rate
+        # Only these channels are loaded, either as "label (unit)" column names or bare labels. None loads everything
+        self.channels = channels
 
     def load_data(self) -> tuple:
         try:
-            data_dict = loadmat(self.filepath)
-            return data_dict['data'], data_dict['labels'].flatten(), data_dict['units'].flatten()
+            if Path(self.filepath).suffix.lower() == '.acq':
+                return self._load_acq()
+            # MATLAB v7.3 files are HDF5 and can be read channel by channel instead of all at once
+            if h5py.is_hdf5(self.filepath):
+                return self._load_hdf5()
+            return self._load_mat()
         except (FileNotFoundError, IOError) as e:
             logging.error(f"Error loading mat file: {e}")
             return None, None, None
 
+    def _load_mat(self) -> tuple:
+        # v5 .mat files can only be read whole, the unrequested channels are dropped right away
+        data_dict = loadmat(self.filepath)
+        labels, units = _strings(data_dict['labels'].flatten()), _strings(data_dict['units'].flatten())
+        indices = self._channel_indices(labels, units)
+        if len(indices) == len(labels):
+            return data_dict['data'], labels, units
+        return np.asfortranarray(data_dict['data'][:, indices]), labels[indices], units[indices]
+
+    def _load_hdf5(self) -> tuple:
+        with h5py.File(self.filepath, 'r') as f:
+            labels, units = _h5_strings(f, 'labels'), _h5_strings(f, 'units')
+            indices = self._channel_indices(labels, units)
+            dataset = f['data']
+            # MATLAB stores the samples x channels matrix column-major, so h5py sees it as channels x samples
+            if dataset.shape[0] != len(labels):
+                raise IOError(f"Unexpected data shape {dataset.shape} for {len(labels)} channels")
+
+            offset = dataset.id.get_offset()
+            if offset is not None and dataset.compression is None and dataset.chunks is None:
+                # Contiguous and uncompressed: memory-map the file, pages are only read when the samples are used
+                mapped = np.memmap(self.filepath, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+                data = mapped.T if len(indices) == len(labels) else mapped[indices].T
+            else:
+                # Read one channel at a time straight into the columns of a Fortran-ordered array
+                data = np.empty((dataset.shape[1], len(indices)), dtype=SIGNAL_DTYPE, order='F')
+                for column, index in enumerate(indices):
+                    dataset.read_direct(data.T, np.s_[index:index + 1, :], np.s_[column:column + 1, :])
+        return data, labels[indices], units[indices]
+
+    def _load_acq(self) -> tuple:
+        # Read the headers first so only the requested channels are read from the AcqKnowledge file
+        headers = bioread.read_headers(str(self.filepath))
+        labels = _strings([channel.name for channel in headers.channels])
+        units = _strings([channel.units for channel in headers.channels])
+        indices = self._channel_indices(labels, units)
+        if len(indices) == 0:
+            raise IOError(f"None of the requested channels are in {self.filepath}")
+        datafile = bioread.read(str(self.filepath), channel_indexes=indices.tolist())
+
+        # Slower channels are stored with a frequency divider, repeat their samples up to the file's native rate
+        channels = [datafile.channels[i] for i in indices]
+        n_samples = min(len(channel.data) * channel.frequency_divider for channel in channels)
+        data = np.empty((n_samples, len(channels)), dtype=SIGNAL_DTYPE, order='F')
+        for column, channel in enumerate(channels):
+            data[:, column] = channel.data[np.arange(n_samples) // channel.frequency_divider]
+
+        native_rate = int(round(datafile.samples_per_second))
+        if self.sampling_rate and self.sampling_rate != native_rate:
+            logging.warning(f"Sampling rate {self.sampling_rate} differs from the file's native rate {native_rate}, using {native_rate}")
+        self.sampling_rate = native_rate
+        return data, labels[indices], units[indices]
+
+    def _channel_indices(self, labels: np.array, units: np.array) -> np.array:
+        if self.channels is None:
+            return np.arange(len(labels))
+        columns = [f'{label} ({unit})' for label, unit in zip(labels, units)]
+        indices = [i for i, (label, column) in enumerate(zip(labels, columns))
+                   if column in self.channels or label in self.channels]
+        missing = set(self.channels) - set(columns) - set(labels)
+        if missing:
+            logging.warning(f"Channels not found in {self.filepath}: {sorted(missing)}")
+        return np.array(indices, dtype=int)
+
     def create_dataframe(self, data: np.array, labels: np.array, units: np.array) -> pd.DataFrame:
         labels_units = [f'{label} ({unit})' for label, unit in zip(labels, units)]
-        return pd.DataFrame(data, columns=labels_units)
+        # Signals are kept in float32 (see read.dtypes), copy=False wraps the array instead of duplicating it
+        if data.dtype.kind == 'f':
+            data = data.astype(SIGNAL_DTYPE, copy=False)
+        return pd.DataFrame(data, columns=labels_units, copy=False)
     
-    def save2path(self, df: pd.DataFrame, researcher_initials: str, participant_id: str):
+    def save2path(self, df: pd.DataFrame, researcher_initials: str, participant_id: str, file_format: str = DEFAULT_FORMAT):
         current_date = datetime.now().strftime("%Y_%m_%d")
-        raw_excel_file_name = f"preprocessed_data_{participant_id}_{researcher_initials}_{current_date}.csv"
+        raw_excel_file_name = f"preprocessed_data_{participant_id}_{researcher_initials}_{current_date}"
         script_dir = Path(__file__).resolve().parent.parent
         data_folder = script_dir.parent / "data" / "raw"
         raw_excel_path = data_folder / raw_excel_file_name
         if not data_folder.exists():
             data_folder.mkdir(parents=True)
-        df.to_csv(raw_excel_path)
-        return raw_excel_path
+        return save_dataframe(df, raw_excel_path, file_format)
+
+
+def _strings(values: np.array) -> np.array:
+    # loadmat pads char matrices with spaces to the longest label
+    return np.array([str(value).rstrip('\x00').strip() for value in values], dtype=object)
 
+def _h5_strings(f: h5py.File, name: str) -> np.array:
+    dataset = f[name]
+    if dataset.dtype == h5py.ref_dtype:
+        # Cell array of strings: every cell is a reference to its own uint16 char array
+        return _strings([''.join(map(chr, f[ref][()].flatten())) for ref in dataset[()].flatten()])
+    # Char matrix, stored transposed as (label length x number of labels)
+    return _strings([''.join(map(chr, row)) for row in dataset[()].T])
 
-def main(data_file: Path, sampling_rate: int, researcher_initials: str, participant_id: str):
+def main(data_file: Path, sampling_rate: int, researcher_initials: str, participant_id: str, channels: list = None, file_format: str = DEFAULT_FORMAT, profiler=None):
     print("Reading dataset...")
     logger = logging.getLogger(__name__)
-    logger.info('making final data set from .mat raw data')
+    logger.info('making final data set from .mat/.acq raw data')
+    profiler = profiler or NullProfiler()
 
-    data_prep = DataPreparation(data_file, sampling_rate)
-    data, labels, units = data_prep.load_data()
+    data_prep = DataPreparation(data_file, sampling_rate, channels)
+    with profiler.stage("load_data"):
+        data, labels, units = data_prep.load_data()
 
     if data is not None:
-        df = data_prep.create_dataframe(data, labels, units)
-        raw_excel_path = data_prep.save2path(df, researcher_initials, participant_id)
-        print(f"Dataset created and saved in {raw_excel_path}")
+        with profiler.stage("create_dataframe"):
+            df = data_prep.create_dataframe(data, labels, units)
+        with profiler.stage("save_raw") as stage:
+            raw_excel_path = data_prep.save2path(df, researcher_initials, participant_id, file_format)
+            stage["bytes_written"] += raw_excel_path.stat().st_size
+        print(f"Dataset created and saved in {raw_excel_path} ({megabytes(memory_bytes(df))} in memory)")
+        profiler.metadata.update(data_file=str(data_file), sampling_rate=data_prep.sampling_rate,
+                                 n_samples=len(df), channels=list(df.columns))
 
-    return df
+    # .acq files carry their own sampling rate, which replaces the one typed in
+    return df, data_prep.sampling_rate
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,49 @@
+import pandas as pd
+from pathlib import Path
+
+# Parquet is compressed, typed and lets readers pick columns. CSV is kept for legacy tools (e.g. Excel)
+FORMATS = {"parquet": ".parquet", "feather": ".feather", "csv": ".csv"}
+DEFAULT_FORMAT = "parquet"
+
+def save_dataframe(df: pd.DataFrame, path: Path, file_format: str = DEFAULT_FORMAT) -> Path:
+    '''
+    Save df to path (the suffix is set from file_format) and return the final path.
+    '''
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown file format: {file_format}, expected one of {list(FORMATS)}")
+    path = Path(path).with_suffix(FORMATS[file_format])
+
+    if file_format == "parquet":
+        df.to_parquet(path, compression="zstd")
+    elif file_format == "feather":
+        # Feather can't store an index, the DataFrames here only have the default RangeIndex anyway
+        df.reset_index(drop=True).to_feather(path, compression="zstd")
+    else:
+        df.to_csv(path)
+    return path
+
+def load_dataframe(path: Path, columns: list = None) -> pd.DataFrame:
+    '''
+    Load a DataFrame saved by save_dataframe, optionally only the given columns.
+    '''
+    path = Path(path)
+    suffix = path.suffix.lower()
+
+    if suffix == FORMATS["parquet"]:
+        return pd.read_parquet(path, columns=columns)
+    if suffix == FORMATS["feather"]:
+        return pd.read_feather(path, columns=columns)
+    if suffix == FORMATS["csv"]:
+        df = pd.read_csv(path, index_col=0)
+        return df[columns] if columns is not None else df
+    raise ValueError(f"Unknown file format: {path}")
+
+def find_saved(path: Path) -> Path:
+    '''
+    Find the saved file for path whatever format it was written in (path is given without suffix).
+    '''
+    for suffix in FORMATS.values():
+        candidate = Path(path).with_suffix(suffix)
+        if candidate.exists():
+            return candidate
+    return None
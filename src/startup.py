@@ -0,0 +1,78 @@
+''' Fast startup of the GUI.
+
+The GUI only needs Tkinter, while the analysis needs NeuroKit, pandas, scipy and matplotlib, which
+take seconds to import (more on a cold disk). main.py shows the window first, and the worker running
+the analyses (see gui/jobs.py) imports the analysis modules while the form is filled in, so they are
+usually loaded by the time it is submitted. StartupTimer records when the window appeared and when
+the libraries were loaded, the times are printed and saved in the run report of the first analysis.
+'''
+import threading
+import time
+from importlib import import_module
+
+try:
+    import psutil
+except ImportError:  # the interpreter startup is only measured when psutil is installed
+    psutil = None
+
+# The modules the analysis runs with, they import the heavy libraries
+ANALYSIS_MODULES = ["numpy", "pandas", "scipy.signal", "matplotlib.pyplot", "neurokit2",
+                    "profiling", "features.cache", "features.resample", "pipeline"]
+
+def process_age() -> float:
+    '''
+    Seconds since the process started, including the startup of the interpreter (0 without psutil).
+    '''
+    if psutil is None:
+        return 0.0
+    return max(time.time() - psutil.Process().create_time(), 0.0)
+
+class StartupTimer:
+    '''
+    Seconds from the start of the process to each milestone of the startup.
+    '''
+    def __init__(self):
+        self._start = time.perf_counter() - process_age()
+        self.times = {}
+
+    def mark(self, name: str) -> float:
+        self.times[name] = round(time.perf_counter() - self._start, 3)
+        return self.times[name]
+
+    def record(self, name: str, seconds: float):
+        self.times[name] = round(seconds, 3)
+
+class BackgroundImport:
+    '''
+    Imports modules in a daemon thread. wait() blocks until they are imported.
+    '''
+    def __init__(self, modules: list = None):
+        self.modules = modules or ANALYSIS_MODULES
+        self.seconds = None
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name="background-import", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            for module in self.modules:
+                import_module(module)
+        except Exception as error:  # raised in the main thread by wait()
+            self.error = error
+        self.seconds = time.perf_counter() - start
+
+    def wait(self) -> float:
+        '''
+        Seconds waited for the imports to finish.
+        '''
+        start = time.perf_counter()
+        if not self._thread.is_alive() and self.seconds is None:
+            self.start()
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return time.perf_counter() - start
@@ -0,0 +1,40 @@
+import numpy as np
+
+def minmax_decimate(x, y, n_bins: int):
+    '''
+    Reduce (x, y) to the minimum and maximum sample of each of n_bins equal bins, kept in their
+    original order. Drawn one bin per pixel column this looks the same as the full signal,
+    including narrow peaks (SCRs, heart rate spikes) that plain downsampling would skip.
+    '''
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    if n_bins <= 0 or len(y) <= 2 * n_bins:
+        return x, y
+
+    bin_size = -(-len(y) // n_bins)  # ceil
+    n_padded = bin_size * n_bins
+    # NaN samples (e.g. rates before the first peak) never win, a NaN-only bin just keeps its first sample
+    y_for_min = np.full(n_padded, np.inf)
+    y_for_min[:len(y)] = np.where(np.isnan(y), np.inf, y)
+    y_for_max = np.full(n_padded, -np.inf)
+    y_for_max[:len(y)] = np.where(np.isnan(y), -np.inf, y)
+
+    bin_starts = np.arange(n_bins) * bin_size
+    argmins = y_for_min.reshape(n_bins, bin_size).argmin(axis=1) + bin_starts
+    argmaxs = y_for_max.reshape(n_bins, bin_size).argmax(axis=1) + bin_starts
+    # Bins don't overlap, so sorting all the indices keeps min/max in time order within each bin
+    indices = np.unique(np.concatenate([argmins, argmaxs]))
+    indices = indices[indices < len(y)]
+    return x[indices], y[indices]
+
+def pixel_width(ax) -> int:
+    # Width of the axes in pixels, i.e. how many bins are worth drawing
+    return max(1, int(ax.get_window_extent().width))
+
+def plot_decimated(ax, x, y, **kwargs):
+    '''
+    ax.plot(x, y, **kwargs) with (x, y) decimated to the axes' pixel width, so the
+    render time depends on the figure size and not on the length of the recording.
+    '''
+    x_decimated, y_decimated = minmax_decimate(x, y, pixel_width(ax))
+    return ax.plot(x_decimated, y_decimated, **kwargs)
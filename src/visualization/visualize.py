@@ -1,102 +1,150 @@
 import numpy as np
 import pandas as pd
 import neurokit2 as nk
+import matplotlib
 import matplotlib.pyplot as plt
 import os
+import webbrowser
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
+from features.build_features import EXECUTORS
+from features.protocol import epoch_bounds, cut_epochs
+from features.peak_index import split_markers, with_markers
+from features.resample import modality_rate, resample_events
+from analysis.group_analysis import long_table
+from read.storage import save_dataframe
+from visualization.decimate import plot_decimated
+from profiling import NullProfiler, timed
 
 class NKPlotProcessed:
-    def __init__(self, df, sampling_rate, processed_dataframes, researcher_initials, participant_id):
+    def __init__(self, df, sampling_rate, processed_dataframes, researcher_initials, participant_id, headless=False):
         self.df = df
         self.sampling_rate = sampling_rate
         self.processed_dataframes = processed_dataframes
         self.time = self.generate_time()  
         self.researcher_initials = researcher_initials
         self.participant_id = participant_id
+        self.headless = headless
 
     def generate_time(self):
         """Generate time array in minutes."""
         return np.arange(len(self.df)) / self.sampling_rate / 60
     
     def plot_processed(self, ecg=False, rsp=False, eda=False, ppg=False, slider=False):
+        """Plot the checked modalities, returns the paths of the saved figures."""
         figures_folder = create_folder_for_figures(self.researcher_initials, self.participant_id)
+        saved = []
         if ecg:
             print(self.processed_dataframes['ecg'])
             nk.ecg_plot(self.processed_dataframes['ecg'], sampling_rate=self.sampling_rate)
-            plt.savefig(figures_folder / "ecg_plot.png")
-            plt.show()
+            saved.append(finish_figure(figures_folder / "ecg_plot.png", self.headless))
         if rsp:
             nk.rsp_plot(self.processed_dataframes['rsp'], sampling_rate=self.sampling_rate)
-            plt.savefig(figures_folder / "rsp_plot.png")
-            plt.show()
+            saved.append(finish_figure(figures_folder / "rsp_plot.png", self.headless))
         if eda:
             nk.eda_plot(self.processed_dataframes['eda'], sampling_rate=self.sampling_rate)
-            plt.savefig(figures_folder / "eda_plot.png")
-            plt.show()
+            saved.append(finish_figure(figures_folder / "eda_plot.png", self.headless))
         if ppg:
             nk.ppg_plot(self.processed_dataframes['ppg'], sampling_rate=self.sampling_rate)
-            plt.savefig(figures_folder / "ppg_plot.png")
-            plt.show()
+            saved.append(finish_figure(figures_folder / "ppg_plot.png", self.headless))
         if slider:
-            plt.plot(self.time, self.processed_dataframes['slider'])
+            # Hour-long recordings are decimated to the figure width, keeping the min/max of each pixel
+            plot_decimated(plt.gca(), self.time, self.processed_dataframes['slider']['slider'])
             plt.xlabel("Time (minutes)")
             plt.ylabel("Slider Score")
             plt.title("Filtered Slider Score Over Time")
-            plt.savefig(figures_folder / "slider_plot.png")
-            plt.show()
+            saved.append(finish_figure(figures_folder / "slider_plot.png", self.headless))
+        return saved
         
 class HRVPlot:
-    def __init__(self, df, sampling_rate, researcher_initials, participant_id):
-        self.df = df
+    def __init__(self, rpeaks, n_samples, sampling_rate, researcher_initials, participant_id, headless=False):
+        # rpeaks are the sample indices of the R-peaks found by nk.ecg_process, reused instead of detecting them again
+        self.rpeaks = rpeaks
+        self.n_samples = n_samples
         self.sampling_rate = sampling_rate
         self.researcher_initials = researcher_initials
         self.participant_id = participant_id
+        self.headless = headless
 
     def plot(self):
-        # Processing ECG data for HRV is like making a special dish with extra steps.
-        ecg = self.df["ECG100C (mV)"].values
-        peaks, info = nk.ecg_peaks(ecg, sampling_rate=self.sampling_rate)
-        nk.hrv(peaks, sampling_rate=self.sampling_rate, show=True)
+        nk.hrv(self.rpeaks, sampling_rate=self.sampling_rate, show=True)
 
         figures_folder = create_folder_for_figures(self.researcher_initials, self.participant_id)
         plt.savefig(figures_folder / "hrv_plot.png")
+        if self.headless:
+            plt.close()
+        return [figures_folder / "hrv_plot.png"]
+
+    def hrv_per_event(self, events):
+        '''
+        Time and frequency domain HRV of every event, from the R-peaks between its onset and the next onset.
+        Returns a table with the events as columns, like SaveExcelTableAndPlotBars.analysis_dataframe.
+        '''
+        # Same epochs as the Excel table, the protocol's include/exclude rules apply
+        labels, onsets, offsets = epoch_bounds(events, self.n_samples)
+        # The peaks are sorted, so each event's peaks are a slice found by binary search
+        starts = np.searchsorted(self.rpeaks, onsets)
+        stops = np.searchsorted(self.rpeaks, offsets)
+
+        results_list = []
+        for label, start, stop in zip(labels, starts, stops):
+            event_peaks = self.rpeaks[start:stop]
+            if len(event_peaks) < 3:
+                print(f"Warning: not enough R-peaks for HRV in event {label}")
+                continue
+            result = pd.concat([nk.hrv_time(event_peaks, sampling_rate=self.sampling_rate),
+                                nk.hrv_frequency(event_peaks, sampling_rate=self.sampling_rate)], axis=1)
+            result.insert(0, 'Event_Label', label)
+            results_list.append(result)
+
+        if not results_list:
+            return pd.DataFrame()
+        results_df = pd.concat(results_list, ignore_index=True)
+        return results_df.set_index("Event_Label").transpose()
+
+    def save2path(self, hrv_df):
+        current_date = datetime.now().strftime("%Y_%m_%d")
+        csv_file_name = f"processed_data_hrv_{self.participant_id}_{self.researcher_initials}_{current_date}.csv"
+        script_dir = Path(__file__).resolve().parent.parent
+        data_folder = script_dir.parent / "data" / "processed"
+        if not data_folder.exists():
+            data_folder.mkdir(parents=True)
+        hrv_df.to_csv(data_folder / csv_file_name)
+        print(f"HRV per event saved at {data_folder / csv_file_name}")
+
+def _analyze_epoch(analysis_function, epoch, sampling_rate):
+    return analysis_function(epoch, sampling_rate=sampling_rate)
 
 class SaveExcelTableAndPlotBars:
-    def __init__(self, processed_dataframes, events, sampling_rate, researcher_initials, participant_id):
+    def __init__(self, processed_dataframes, events, sampling_rate, researcher_initials, participant_id, executor=None, max_workers=None, peaks=None, sampling_rates=None):
         self.events = events
+        # Sample indices of the markers of each modality, turned into dense columns per epoch only
+        self.peaks = peaks
+        # With executor="thread" or "process" every (modality, epoch) analysis runs on a worker pool
+        self.executor = executor
+        self.max_workers = max_workers
         self.sampling_rate = sampling_rate
+        # Target rates of the resampled modalities, the events are at sampling_rate (see features.resample)
+        self.sampling_rates = sampling_rates
         self.processed_dataframes = processed_dataframes
-        self.ecg_signals = self.processed_dataframes['ecg']
-        self.rsp_signals = self.processed_dataframes['rsp']
-        self.eda_signals = self.processed_dataframes['eda']
+        # Missing when the object is only used to plot the bar graphs
+        self.ecg_signals = self.processed_dataframes.get('ecg')
+        self.rsp_signals = self.processed_dataframes.get('rsp')
+        self.eda_signals = self.processed_dataframes.get('eda')
         self.researcher_initials = researcher_initials
         self.participant_id = participant_id
 
-    def analysis_dataframe(self, analysis_function, signal):
-        results_list = []
-
-        for i, (onset, label) in enumerate(zip(self.events["onset"], self.events["label"])):
-
-            # Ignore events with the label "pci"
-            if "pci" in label.lower():
-                continue # Skip this iteration of the loop
-
-            print(label)
-            #get the offset of the events
-            if i < len(self.events["onset"]) - 1:
-                offset = self.events["onset"][i + 1]
-            else:
-                offset = len(signal) # Last event
-
-            print(f"onset: {onset}, offset: {offset}")
-            epoch = signal.iloc[onset:offset] # Get the epoch, onset to offset
+    def _epochs(self, signal):
+        '''
+        Cut the signal into one epoch per analyzed event, from its onset to its offset.
+        Returns a list of (label, epoch).
+        '''
+        return cut_epochs({'signal': signal}, self.events).get('signal', [])
 
-            if epoch.empty:
-                print(f"Warning: Empty epoch for label {label}")
-                continue
-            # Run the analysis function on the epoch
-            result = analysis_function(epoch, sampling_rate=self.sampling_rate)
+    def _results_table(self, labels, results):
+        results_list = []
+        for label, result in zip(labels, results):
             result.insert(0, 'Event_Label', label)
             results_list.append(result)
 
@@ -106,16 +154,53 @@ class SaveExcelTableAndPlotBars:
         print(results_df)
         return results_df
 
-    def analysis_data_signals(self):
-        eda_analysis_df = self.analysis_dataframe(nk.eda_intervalrelated, self.eda_signals)
-        ecg_analysis_df = self.analysis_dataframe(nk.ecg_analyze, self.ecg_signals)
-        rsp_analysis_df = self.analysis_dataframe(nk.rsp_intervalrelated, self.rsp_signals)
+    def _analyze_epochs(self, analysis_function, epochs, sampling_rate=None):
+        # Run the analysis function on each epoch
+        results = [_analyze_epoch(analysis_function, epoch, sampling_rate or self.sampling_rate) for _, epoch in epochs]
+        return self._results_table([label for label, _ in epochs], results)
 
-        return eda_analysis_df, ecg_analysis_df, rsp_analysis_df
+    def analysis_dataframe(self, analysis_function, signal):
+        return self._analyze_epochs(analysis_function, self._epochs(signal))
+
+    def analysis_data_signals(self):
+        analyses = {
+            'eda': (nk.eda_intervalrelated, self.eda_signals),
+            'ecg': (nk.ecg_analyze, self.ecg_signals),
+            'rsp': (nk.rsp_intervalrelated, self.rsp_signals),
+        }
+
+        # The epoch bounds are computed once and every modality is cut with them
+        epochs = cut_epochs({signal_type: signal for signal_type, (_, signal) in analyses.items()}, self.events, self.peaks,
+                            self.sampling_rate, self.sampling_rates)
+        rates = {signal_type: modality_rate(self.sampling_rate, self.sampling_rates, signal_type) for signal_type in analyses}
+
+        if self.executor is None:
+            tables = {signal_type: self._analyze_epochs(analyses[signal_type][0], signal_epochs, rates[signal_type])
+                      for signal_type, signal_epochs in epochs.items()}
+        else:
+            if self.executor not in EXECUTORS:
+                raise ValueError(f"Unknown executor: {self.executor}, expected one of {list(EXECUTORS)}")
+            with EXECUTORS[self.executor](max_workers=self.max_workers) as pool:
+                if self.executor == "thread":
+                    # NeuroKit's interval-related functions collect their results in a shared default argument,
+                    # so epochs of the same modality can't run in parallel threads. Run one thread per modality
+                    futures = {signal_type: pool.submit(self._analyze_epochs, analyses[signal_type][0], signal_epochs, rates[signal_type])
+                               for signal_type, signal_epochs in epochs.items()}
+                    tables = {signal_type: future.result() for signal_type, future in futures.items()}
+                else:
+                    # Submit the whole modality x epoch grid at once, then reassemble each table in event order
+                    futures = {signal_type: [pool.submit(_analyze_epoch, analyses[signal_type][0], epoch, rates[signal_type])
+                                             for _, epoch in signal_epochs]
+                               for signal_type, signal_epochs in epochs.items()}
+                    tables = {signal_type: self._results_table([label for label, _ in epochs[signal_type]],
+                                                               [future.result() for future in signal_futures])
+                              for signal_type, signal_futures in futures.items()}
+
+        return tables['eda'], tables['ecg'], tables['rsp']
 
     def save2path(self, eda_analysis_df, ecg_analysis_df, rsp_analysis_df, feature_type: str):
         current_date = datetime.now().strftime("%Y_%m_%d")
-        excel_file_name = f"processed_data_{feature_type}_{self.participant_id}_{self.researcher_initials}_{current_date}.csv"
+        excel_file_name = f"processed_data_{feature_type}_{self.participant_id}_{self.researcher_initials}_{current_date}.xlsx"
         script_dir = Path(__file__).resolve().parent.parent
         data_folder = script_dir.parent / "data" / "processed"
         excel_path = data_folder / excel_file_name
@@ -129,11 +214,25 @@ class SaveExcelTableAndPlotBars:
 
         print(f"Results saved to Excel at {excel_path}")
 
+    def save_long(self, eda_analysis_df, ecg_analysis_df, rsp_analysis_df):
+        '''
+        Save the results as one tidy table (a row per event, modality and feature) that the group analysis appends.
+        '''
+        current_date = datetime.now().strftime("%Y_%m_%d")
+        tables = {'eda': eda_analysis_df, 'ecg': ecg_analysis_df, 'rsp': rsp_analysis_df}
+        long = long_table(tables, self.participant_id, self.researcher_initials, current_date, self.events.get('protocol'))
+        script_dir = Path(__file__).resolve().parent.parent
+        data_folder = script_dir.parent / "data" / "processed"
+        long_path = save_dataframe(long, data_folder / f"processed_data_long_{self.participant_id}_{self.researcher_initials}_{current_date}", "parquet")
+        print(f"Results saved for the group analysis at {long_path}")
+
     def plot_bargraphs(self, dataframe, feature_type: str):
         '''
         The function plots bar graphs for important rows in each dataframe based on feature type.
+        Returns the paths of the saved plots.
         '''
         figures_folder = create_folder_for_figures(self.researcher_initials, self.participant_id)
+        saved = []
 
         important_rows = []  # Rows you want to focus on for plotting
 
@@ -146,7 +245,7 @@ class SaveExcelTableAndPlotBars:
             important_rows = ['ECG_Rate_Mean', 'HRV_MeanNN']
         else:
             print(f"Unknown feature_type: {feature_type}")
-            return
+            return saved
 
         print(f"Plotting bar graphs for {feature_type}...")
         
@@ -178,24 +277,35 @@ class SaveExcelTableAndPlotBars:
             plot_path = figures_folder / f"{row}_{feature_type}_{self.participant_id}_{self.researcher_initials}.png"
             plt.savefig(plot_path)
             plt.close()
+            saved.append(plot_path)
 
         print(f"Plots saved at {figures_folder}")
+        return saved
 
 
 class RatesAndEvents:
-    def __init__(self, sampling_rate, df, events, processed_dataframes, researcher_initials, participant_id):
+    def __init__(self, sampling_rate, df, events, processed_dataframes, researcher_initials, participant_id, headless=False, sampling_rates=None):
         self.sampling_rate = sampling_rate
+        # Resampled modalities have their own time axis, the events stay at sampling_rate
+        self.sampling_rates = sampling_rates
         self.time = self.generate_time(df)
         self.events = events
         self.df = df
         self.processed_dataframes = processed_dataframes
         self.researcher_initials = researcher_initials
         self.participant_id = participant_id
+        self.headless = headless
     
     def generate_time(self, df):
         """Generate time array in minutes."""
         return np.arange(len(df)) / self.sampling_rate / 60
 
+    def time_of(self, signal_type):
+        """Time array in minutes of a modality, at its own rate."""
+        if modality_rate(self.sampling_rate, self.sampling_rates, signal_type) == self.sampling_rate:
+            return self.time
+        return np.arange(len(self.processed_dataframes[signal_type])) / modality_rate(self.sampling_rate, self.sampling_rates, signal_type) / 60
+
     def annotate_events(self):
         event_onsets_indices = self.events['onset']
         event_labels = self.events['label']
@@ -210,33 +320,36 @@ class RatesAndEvents:
         plt.figure(figsize=(15, 12))
         plt.suptitle("Data Visualization", fontsize=20)
 
+        # Every trace is decimated to the pixel width of its subplot (min/max per pixel), so hour-long
+        # recordings render as fast as short ones and SCR/heart rate spikes stay visible
+
         # Heart Rate (ECG) subplot        
         plt.subplot(5, 1, 1)
-        plt.plot(self.time, self.processed_dataframes['ecg']['ECG_Rate'], color='cyan', linewidth=0.5)
+        plot_decimated(plt.gca(), self.time_of('ecg'), self.processed_dataframes['ecg']['ECG_Rate'], color='cyan', linewidth=0.5)
         plt.title("Heart Rate (BPM)")
         self.annotate_events()
 
         # Breathing Rate (RSP) subplot
         plt.subplot(5, 1, 2)
-        plt.plot(self.time, self.processed_dataframes['rsp']['RSP_Rate'], color='blue', linewidth=0.5) # Fixed 'ecg' to 'rsp'
+        plot_decimated(plt.gca(), self.time_of('rsp'), self.processed_dataframes['rsp']['RSP_Rate'], color='blue', linewidth=0.5) # Fixed 'ecg' to 'rsp'
         plt.title("Breathing Rate")
         self.annotate_events()
 
         # SCR (EDA) subplot
         plt.subplot(5, 1, 3)
-        plt.plot(self.time, self.processed_dataframes['eda']["EDA_Phasic"], color='green', linewidth=0.5)
+        plot_decimated(plt.gca(), self.time_of('eda'), self.processed_dataframes['eda']["EDA_Phasic"], color='green', linewidth=0.5)
         plt.title("SCR (EDA)")
         self.annotate_events()
 
         # SCL (EDA) subplot
         plt.subplot(5, 1, 4)
-        plt.plot(self.time, self.processed_dataframes['eda']["EDA_Tonic"], color='orange', linewidth=0.5)
+        plot_decimated(plt.gca(), self.time_of('eda'), self.processed_dataframes['eda']["EDA_Tonic"], color='orange', linewidth=0.5)
         plt.title("SCL (EDA)")
         self.annotate_events()
 
         # Slider subplot
         plt.subplot(5,1,5)
-        plt.plot(self.time, self.processed_dataframes['slider'], color='purple', linewidth=0.5)
+        plot_decimated(plt.gca(), self.time_of('slider'), self.processed_dataframes['slider']['slider'], color='purple', linewidth=0.5)
         plt.title("Slider Score")
         self.annotate_events()
 
@@ -245,8 +358,35 @@ class RatesAndEvents:
         # Get folder path to save figures
         folder_path = create_folder_for_figures(self.researcher_initials, self.participant_id)
         # Create figure name and save
-        plt.savefig(folder_path / "rates&events_plot.png")
+        return [finish_figure(folder_path / "rates&events_plot.png", self.headless)]
+
+# Utility function to save the current figure, then show it (blocking) or close it when rendering headless
+def finish_figure(path, headless=False):
+    plt.savefig(path)
+    if headless:
+        plt.close()
+    else:
         plt.show()
+    return path
+
+# Utility function to write an HTML page with every figure of the run, and optionally open it
+def save_report(figures_folder, figure_paths, open_report=False):
+    # Only the figures of this run, the folder also has those of earlier runs of the day
+    images = "\n".join(f'<h3>{path.stem}</h3>\n<img src="{path.name}" style="max-width:100%">' for path in figure_paths)
+    report_path = figures_folder / "report.html"
+    report_path.write_text(f"<html><body>\n<h1>{figures_folder.name}</h1>\n{images}\n</body></html>\n")
+    print(f"Report saved at {report_path}")
+    if open_report:
+        webbrowser.open(report_path.as_uri())
+    return report_path
+
+def _init_render_worker():
+    # Render workers never have a display
+    matplotlib.use("Agg")
+
+def _render(plotter, method_name, kwargs):
+    # Returns the paths the figure saved and its (wall, CPU) time, measured in the worker process
+    return timed(getattr(plotter, method_name), **kwargs)
 
 # Utility function to create and return the new directory path
 def create_folder_for_figures(researcher_initials, participant_id):
@@ -258,29 +398,111 @@ def create_folder_for_figures(researcher_initials, participant_id):
         figures_folder.mkdir(parents=True) 
     return figures_folder
 
-def main(df: pd.DataFrame, processed_dataframes: pd.DataFrame, sampling_rate: int, researcher_initials: str, participant_id: str, events, HRV=False, excel_table=False, ecg=False, rsp=False, eda=False, ppg=False, slider=False, rates_and_events=False):
-    print("Visualizing data...")
-    
-    plot_processed = NKPlotProcessed(df, sampling_rate, processed_dataframes, researcher_initials, participant_id)
-    plot_processed.plot_processed(ecg, rsp, eda, ppg, slider)
+def figure_tasks(index: pd.DataFrame, processed_dataframes: dict, peaks: dict, sampling_rate: int, researcher_initials: str, participant_id: str, events,
+                 HRV=False, ecg=False, rsp=False, eda=False, ppg=False, slider=False, rates_and_events=False, analysis_tables=None, headless=False,
+                 sampling_rates=None) -> list:
+    '''
+    The figures to render as (name, plotter, method name, kwargs) tasks. The plotters only get the data their figure needs,
+    index is the recording without its columns (df[[]]), so they are cheap to send to a worker process.
+    analysis_tables are the (eda, ecg, rsp) tables of the Excel table, plotted as bar graphs. sampling_rates are the
+    target rates of the resampled modalities (see features.resample).
+    '''
+    render_tasks = []
+
+    for signal_type, flag in {'ecg': ecg, 'rsp': rsp, 'eda': eda, 'ppg': ppg, 'slider': slider}.items():
+        if flag:
+            # NeuroKit's plots need the dense marker columns back
+            processed_df = with_markers(processed_dataframes[signal_type], peaks.get(signal_type))
+            plot_processed = NKPlotProcessed(processed_df[[]], modality_rate(sampling_rate, sampling_rates, signal_type), {signal_type: processed_df},
+                                             researcher_initials, participant_id, headless)
+            render_tasks.append((f"plot_{signal_type}", plot_processed, "plot_processed", {signal_type: True}))
 
     if rates_and_events:
-        rates_and_events_plotter = RatesAndEvents(sampling_rate, df, events, processed_dataframes, researcher_initials, participant_id)
-        rates_and_events_plotter.plot_rates_and_events()
+        rate_columns = {'ecg': ['ECG_Rate'], 'rsp': ['RSP_Rate'], 'eda': ['EDA_Phasic', 'EDA_Tonic'], 'slider': ['slider']}
+        rates = {signal_type: processed_dataframes[signal_type][columns] for signal_type, columns in rate_columns.items()}
+        rates_and_events_plotter = RatesAndEvents(sampling_rate, index, events, rates, researcher_initials, participant_id, headless, sampling_rates)
+        render_tasks.append(("plot_rates_and_events", rates_and_events_plotter, "plot_rates_and_events", {}))
 
     if HRV:
-        hrv_plot = HRVPlot(df, sampling_rate, researcher_initials, participant_id)
-        hrv_plot.plot()
-
-    if excel_table:
-        excel_table_obj = SaveExcelTableAndPlotBars(processed_dataframes, events, sampling_rate, researcher_initials, participant_id)
-        eda_analysis_df, ecg_analysis_df, rsp_analysis_df = excel_table_obj.analysis_data_signals()
-        excel_table_obj.save2path(eda_analysis_df, ecg_analysis_df, rsp_analysis_df, "excel_table")
+        hrv_plot = HRVPlot(peaks['ecg']['ECG_R_Peaks'], len(processed_dataframes['ecg']), modality_rate(sampling_rate, sampling_rates, 'ecg'),
+                           researcher_initials, participant_id, headless)
+        render_tasks.append(("plot_hrv", hrv_plot, "plot", {}))
 
+    if analysis_tables is not None:
         # In order to change which rows are plotted, change the important_rows list in the plot_bargraphs function
-        excel_table_obj.plot_bargraphs(rsp_analysis_df, "rsp")
-        excel_table_obj.plot_bargraphs(eda_analysis_df, "eda")
-        excel_table_obj.plot_bargraphs(ecg_analysis_df, "ecg")
-        
-    
-    print("Data visualization complete!")
\ No newline at end of file
+        eda_analysis_df, ecg_analysis_df, rsp_analysis_df = analysis_tables
+        bar_plotter = SaveExcelTableAndPlotBars({}, events, sampling_rate, researcher_initials, participant_id)
+        for analysis_df, feature_type in [(rsp_analysis_df, "rsp"), (eda_analysis_df, "eda"), (ecg_analysis_df, "ecg")]:
+            render_tasks.append((f"plot_bargraphs_{feature_type}", bar_plotter, "plot_bargraphs", {"dataframe": analysis_df, "feature_type": feature_type}))
+    return render_tasks
+
+def render_figures(render_tasks: list, researcher_initials: str, participant_id: str, headless=False, render_workers=None, open_report=False, profiler=None,
+                   progress=None):
+    '''
+    Render the figure tasks, in parallel worker processes when headless, and write the HTML report of the figures.
+    progress(name, status) is called as each figure is rendered.
+    '''
+    profiler = profiler or NullProfiler()
+    progress = progress or (lambda name, status: None)
+    for name, *_ in render_tasks:
+        progress(f"figure {name}", "pending")
+    render_results = {}
+    with profiler.stage("render_figures"):
+        if headless and render_workers != 1 and len(render_tasks) > 1:
+            with ProcessPoolExecutor(max_workers=render_workers, initializer=_init_render_worker) as pool:
+                futures = {pool.submit(_render, *task): name for name, *task in render_tasks}
+                for future in as_completed(futures):
+                    render_results[futures[future]] = future.result()
+                    progress(f"figure {futures[future]}", "done")
+        else:
+            for name, *task in render_tasks:
+                progress(f"figure {name}", "running")
+                render_results[name] = _render(*task)
+                progress(f"figure {name}", "done")
+    for name, (_, wall_time, cpu_time) in render_results.items():
+        profiler.record(name, wall_time_s=wall_time, cpu_time_s=cpu_time)
+
+    if headless:
+        # In the order of the tasks, whatever order they finished in
+        figure_paths = [Path(path) for name, *_ in render_tasks for path in render_results[name][0]]
+        save_report(create_folder_for_figures(researcher_initials, participant_id), figure_paths, open_report)
+
+def main(df: pd.DataFrame, processed_dataframes: pd.DataFrame, sampling_rate: int, researcher_initials: str, participant_id: str, events, HRV=False, excel_table=False, ecg=False, rsp=False, eda=False, ppg=False, slider=False, rates_and_events=False, executor=None, max_workers=None, headless=False, render_workers=None, open_report=False, profiler=None, peaks=None, sampling_rates=None):
+    '''
+    With headless=True no window is opened: every figure is saved with the Agg backend, the independent
+    figures are rendered in parallel worker processes (render_workers=1 renders them in this process)
+    and an HTML report of all figures is written at the end, and opened if open_report is set.
+    peaks are the marker indices returned by build_features, without them the markers are taken
+    from the dense columns of processed_dataframes (e.g. interim files of older runs). sampling_rates
+    are the target rates the modalities were resampled to by build_features, if any.
+    '''
+    print("Visualizing data...")
+    profiler = profiler or NullProfiler()
+    if peaks is None:
+        split = {signal_type: split_markers(processed_df) for signal_type, processed_df in processed_dataframes.items() if processed_df is not None}
+        processed_dataframes = {signal_type: continuous for signal_type, (continuous, _) in split.items()}
+        peaks = {signal_type: modality_peaks for signal_type, (_, modality_peaks) in split.items()}
+    if headless:
+        plt.switch_backend("Agg")
+
+    if HRV:
+        ecg_rate = modality_rate(sampling_rate, sampling_rates, 'ecg')
+        hrv_plot = HRVPlot(peaks['ecg']['ECG_R_Peaks'], len(processed_dataframes['ecg']), ecg_rate, researcher_initials, participant_id, headless)
+        with profiler.stage("hrv_per_event"):
+            hrv_plot.save2path(hrv_plot.hrv_per_event(resample_events(events, sampling_rate, ecg_rate, hrv_plot.n_samples)))
+
+    analysis_tables = None
+    if excel_table:
+        excel_table_obj = SaveExcelTableAndPlotBars(processed_dataframes, events, sampling_rate, researcher_initials, participant_id, executor, max_workers, peaks,
+                                                    sampling_rates)
+        with profiler.stage("interval_analysis"):
+            analysis_tables = excel_table_obj.analysis_data_signals()
+        with profiler.stage("save_excel_table"):
+            excel_table_obj.save2path(*analysis_tables, "excel_table")
+            excel_table_obj.save_long(*analysis_tables)
+
+    render_tasks = figure_tasks(df[[]], processed_dataframes, peaks, sampling_rate, researcher_initials, participant_id, events,
+                                HRV, ecg, rsp, eda, ppg, slider, rates_and_events, analysis_tables, headless, sampling_rates)
+    render_figures(render_tasks, researcher_initials, participant_id, headless, render_workers, open_report, profiler)
+
+    print("Data visualization complete!")
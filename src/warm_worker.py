@@ -0,0 +1,114 @@
+''' A warm worker process for successive analyses from the GUI.
+
+Every launch of main.py pays for starting the interpreter and importing the analysis libraries. The
+warm worker is started once, imports them and runs the analyses submitted by the GUI one after the
+other until it is stopped with Ctrl+C:
+
+    cd src && python -m warm_worker
+
+While it runs, main.py sends the analysis to it instead of running it itself (the progress is
+printed by the worker); otherwise main.py runs the analysis as before. The worker listens on
+localhost only, and clients authenticate with a key it writes to data/warm_worker.key at startup.
+'''
+import argparse
+import os
+import secrets
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener, AuthenticationError
+from pathlib import Path
+from startup import BackgroundImport
+
+DEFAULT_PORT = 6011
+
+def key_path() -> Path:
+    script_dir = Path(__file__).resolve().parent
+    return script_dir.parent / "data" / "warm_worker.key"
+
+def is_running() -> bool:
+    # The key file only exists while a worker is running (or after it was killed)
+    return key_path().exists()
+
+def submit(job: dict, port: int = DEFAULT_PORT, progress=None):
+    '''
+    Run job (the keyword arguments of main.analyse) in the warm worker and return the path of its
+    run report, or None when no worker is running. progress(stage, status) is called with the
+    progress reported by the worker. Closing the connection cancels the job at the next stage.
+    '''
+    if not is_running():
+        return None
+    try:
+        connection = Client(("127.0.0.1", port), authkey=key_path().read_bytes())
+    except (OSError, AuthenticationError):  # stale key file of a killed worker
+        return None
+    with connection:
+        print(f"Analysis sent to the warm worker on port {port}, its progress is printed there")
+        connection.send(job)
+        status, *result = connection.recv()
+        while status == "progress":
+            if progress:
+                progress(*result)
+            status, *result = connection.recv()
+        result = result[0]
+    if status == "error":
+        raise RuntimeError(f"The analysis failed in the warm worker:\n{result}")
+    return result
+
+def serve(port: int = DEFAULT_PORT):
+    from main import analyse
+
+    seconds = BackgroundImport().start().wait()
+    key = secrets.token_bytes(32)
+    if not key_path().parent.exists():
+        key_path().parent.mkdir(parents=True)
+    with Listener(("127.0.0.1", port), authkey=key) as listener:
+        key_path().write_bytes(key)
+        os.chmod(key_path(), 0o600)
+        print(f"Warm worker ready on port {port}, analysis modules imported in {seconds:.1f} s. Stop it with Ctrl+C")
+        try:
+            while True:
+                try:
+                    connection = listener.accept()
+                except AuthenticationError:
+                    continue
+                with connection:
+                    try:
+                        job = connection.recv()
+                    except EOFError:
+                        continue
+                    received = time.perf_counter()
+                    lock = threading.Lock()  # stages report their progress from parallel threads
+                    cancelled = threading.Event()
+
+                    def progress(stage, status, connection=connection, lock=lock, cancelled=cancelled):
+                        # Fails once the client is gone (the job was cancelled), which stops the analysis at the next stage
+                        with lock:
+                            try:
+                                connection.send(("progress", stage, status))
+                            except OSError:
+                                cancelled.set()
+                                raise
+                    try:
+                        reply = ("done", str(analyse(**job, progress=progress)))
+                    except Exception:
+                        if cancelled.is_set():
+                            print("The analysis was cancelled")
+                            continue
+                        traceback.print_exc()
+                        reply = ("error", traceback.format_exc())
+                    try:
+                        connection.send(reply)
+                    except OSError:
+                        print("The client of the analysis is gone")
+                    print(f"Analysis done in {time.perf_counter() - received:.1f} s, waiting for the next one")
+        except KeyboardInterrupt:
+            print("Warm worker stopped")
+        finally:
+            key_path().unlink(missing_ok=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Keep the analysis libraries loaded and run the analyses submitted by the GUI.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port on localhost to listen on (default {DEFAULT_PORT})")
+    args = parser.parse_args()
+    serve(args.port)